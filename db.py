@@ -1,8 +1,9 @@
 import os
 import sqlite3
+from contextlib import contextmanager
 from datetime import datetime
 from pathlib import Path
-from typing import Any, Dict, List, Optional, Tuple
+from typing import Any, Dict, Iterator, List, Optional, Tuple
 
 
 def utcnow() -> str:
@@ -12,6 +13,8 @@ def utcnow() -> str:
 class DB:
     def __init__(self, path: str):
         self.path = path
+        # user_id -> есть ли черновик; читается на каждом kb_menu
+        self._has_draft: Dict[int, bool] = {}
         Path(os.path.dirname(path) or ".").mkdir(parents=True, exist_ok=True)
         self._init()
 
@@ -19,14 +22,42 @@ class DB:
         con = sqlite3.connect(self.path)
         con.row_factory = sqlite3.Row
         con.execute("PRAGMA foreign_keys=ON;")
+        # WAL (включается в _init) + NORMAL: без fsync на каждый коммит
+        con.execute("PRAGMA synchronous=NORMAL;")
+        con.execute("PRAGMA temp_store=MEMORY;")
+        con.execute("PRAGMA mmap_size=268435456;")
         return con
 
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        """Несколько записей одним коммитом (BEGIN IMMEDIATE ... COMMIT)."""
+        con = self._conn()
+        try:
+            con.execute("BEGIN IMMEDIATE")
+            yield con
+            con.commit()
+        except BaseException:
+            con.rollback()
+            raise
+        finally:
+            con.close()
+
+    @contextmanager
+    def _use(self, con: Optional[sqlite3.Connection]) -> Iterator[sqlite3.Connection]:
+        if con is not None:
+            yield con
+        else:
+            with self._conn() as own:
+                yield own
+
     def _col_exists(self, con: sqlite3.Connection, table: str, col: str) -> bool:
         rows = con.execute(f"PRAGMA table_info({table})").fetchall()
         return any(r["name"] == col for r in rows)
 
     def _init(self) -> None:
         with self._conn() as con:
+            # режим журнала хранится в файле БД — достаточно включить один раз
+            con.execute("PRAGMA journal_mode=WAL;")
             con.executescript(
                 """
                 CREATE TABLE IF NOT EXISTS users (
@@ -79,6 +110,9 @@ class DB:
 
                 CREATE INDEX IF NOT EXISTS idx_submissions_user_id ON submissions(user_id);
                 CREATE INDEX IF NOT EXISTS idx_submissions_event_date ON submissions(event_date);
+                -- индекс по выражению (год, месяц) для list_submissions_by_month
+                CREATE INDEX IF NOT EXISTS idx_submissions_month
+                    ON submissions(substr(event_date, 7, 4), substr(event_date, 4, 2));
 
                 CREATE TABLE IF NOT EXISTS docs (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -117,8 +151,14 @@ class DB:
                 con.execute("ALTER TABLE submissions ADD COLUMN sfx_other TEXT NOT NULL DEFAULT ''")
 
     # -------- users last --------
-    def upsert_user_last(self, user_id: int, submission_id: Optional[int], folder_path: Optional[str]) -> None:
-        with self._conn() as con:
+    def upsert_user_last(
+        self,
+        user_id: int,
+        submission_id: Optional[int],
+        folder_path: Optional[str],
+        con: Optional[sqlite3.Connection] = None,
+    ) -> None:
+        with self._use(con) as con:
             con.execute(
                 """
                 INSERT INTO users(user_id, last_submission_id, last_folder_path, updated_at)
@@ -155,6 +195,7 @@ class DB:
                 """,
                 (user_id, fsm_state, draft_json, utcnow()),
             )
+        self._has_draft[user_id] = True
 
     def get_draft(self, user_id: int) -> Optional[sqlite3.Row]:
         with self._conn() as con:
@@ -163,12 +204,28 @@ class DB:
                 (user_id,),
             ).fetchone()
 
-    def delete_draft(self, user_id: int) -> None:
-        with self._conn() as con:
+    def delete_draft(self, user_id: int, con: Optional[sqlite3.Connection] = None) -> None:
+        # в чужой транзакции кэш обновляет вызывающий — после коммита
+        in_tx = con is not None
+        with self._use(con) as con:
             con.execute("DELETE FROM drafts WHERE user_id=?", (user_id,))
+        if not in_tx:
+            self._has_draft[user_id] = False
+
+    def cached_has_draft(self, user_id: int) -> Optional[bool]:
+        """has_draft без запроса: None, если пользователь еще не в кэше."""
+        return self._has_draft.get(user_id)
+
+    def has_draft(self, user_id: int) -> bool:
+        cached = self._has_draft.get(user_id)
+        if cached is None:
+            with self._conn() as con:
+                cached = con.execute("SELECT 1 FROM drafts WHERE user_id=?", (user_id,)).fetchone() is not None
+            self._has_draft[user_id] = cached
+        return cached
 
     # -------- submissions --------
-    def insert_submission(self, user_id: int, a: Dict[str, Any]) -> int:
+    def insert_submission(self, user_id: int, a: Dict[str, Any], con: Optional[sqlite3.Connection] = None) -> int:
         cols = [
             "org", "role", "name", "phone",
             "event_date", "event_title",
@@ -183,7 +240,7 @@ class DB:
         ]
         now = utcnow()
         values = [a.get(c, "") for c in cols]
-        with self._conn() as con:
+        with self._use(con) as con:
             cur = con.execute(
                 f"""
                 INSERT INTO submissions (
@@ -196,6 +253,16 @@ class DB:
             )
             return int(cur.lastrowid)
 
+    def commit_submission(self, user_id: int, a: Dict[str, Any]) -> int:
+        """Сохранить анкету, запомнить ее как последнюю и удалить черновик — одной транзакцией."""
+        with self.transaction() as con:
+            sub_id = self.insert_submission(user_id, a, con=con)
+            self.upsert_user_last(user_id, sub_id, a.get("ydisk_folder"), con=con)
+            self.delete_draft(user_id, con=con)
+        # только после коммита: при откате черновик остается в БД
+        self._has_draft[user_id] = False
+        return sub_id
+
     def update_submission(self, sub_id: int, patch: Dict[str, Any]) -> bool:
         if not patch:
             return False
@@ -249,11 +316,11 @@ class DB:
             return con.execute(
                 """
                 SELECT * FROM submissions
-                WHERE substr(event_date, 4, 2)=? AND substr(event_date, 7, 4)=?
+                WHERE substr(event_date, 7, 4)=? AND substr(event_date, 4, 2)=?
                 ORDER BY event_date ASC, id ASC
                 LIMIT ?
                 """,
-                (mm, yyyy, limit),
+                (yyyy, mm, limit),
             ).fetchall()
 
     def delete_submission(self, sub_id: int) -> bool:
@@ -275,6 +342,10 @@ class DB:
             )
             return int(cur.lastrowid)
 
+    def get_doc(self, doc_id: int) -> Optional[sqlite3.Row]:
+        with self._conn() as con:
+            return con.execute("SELECT * FROM docs WHERE id=?", (doc_id,)).fetchone()
+
     def list_docs(self, user_id: int, limit: int = 30) -> List[sqlite3.Row]:
         with self._conn() as con:
             return con.execute(
@@ -0,0 +1,20 @@
+"""JSON для всего бота: orjson, если установлен, иначе stdlib json."""
+import json
+from typing import Any
+
+try:
+    import orjson
+except ImportError:  # orjson необязателен — без него работает stdlib json
+    orjson = None  # type: ignore[assignment]
+
+
+def json_loads(s: Any) -> Any:
+    if orjson is not None:
+        return orjson.loads(s)
+    return json.loads(s)
+
+
+def json_dumps(obj: Any) -> str:
+    if orjson is not None:
+        return orjson.dumps(obj).decode()
+    return json.dumps(obj, ensure_ascii=False)
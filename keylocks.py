@@ -0,0 +1,29 @@
+"""asyncio.Lock на ключ (путь на Я.Диске и т.п.) без бесконечного роста словаря локов."""
+import asyncio
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, Hashable, List
+
+
+class KeyedLocks:
+    """One asyncio.Lock per key; the lock is dropped once nobody holds or waits for it."""
+
+    def __init__(self) -> None:
+        # key -> [лок, сколько корутин его держат или ждут]
+        self._locks: Dict[Hashable, List] = {}
+
+    def __len__(self) -> int:
+        return len(self._locks)
+
+    @asynccontextmanager
+    async def hold(self, key: Hashable) -> AsyncIterator[None]:
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[key]
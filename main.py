@@ -1,41 +1,59 @@
 import asyncio
-import json
+import logging
+import multiprocessing
 import os
 import re
+import secrets
+import time
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
-from io import BytesIO
-from typing import Any, Dict, List, Optional, Tuple
+from functools import lru_cache
+from typing import Any, Awaitable, Callable, DefaultDict, Dict, FrozenSet, List, Optional, Sequence, Tuple, Union
 
 import httpx
+from aiolimiter import AsyncLimiter
 from dotenv import load_dotenv
-from docx import Document
-from docx.shared import Pt
 
-from aiogram import Bot, Dispatcher, F, Router
+from aiogram import BaseMiddleware, Bot, Dispatcher, F, Router
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
 from aiogram.enums import ParseMode
 from aiogram.filters import CommandStart
 from aiogram.exceptions import TelegramBadRequest
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
+from aiogram.fsm.storage.base import BaseStorage
+from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.methods import GetUpdates, TelegramMethod
+from aiogram.methods.base import Response, TelegramType
 from aiogram.types import (
     BufferedInputFile,
     CallbackQuery,
+    FSInputFile,
     InlineKeyboardButton,
     InlineKeyboardMarkup,
     KeyboardButton,
     Message,
     ReplyKeyboardMarkup,
     ReplyKeyboardRemove,
+    TelegramObject,
 )
 
 from db import DB
+from jsonutil import json_dumps, json_loads
+from keylocks import KeyedLocks
+from render import answers_text, resolve_console_model, submission_to_dict, venue_console
+from word import build_docx_for_submission, build_docx_tempfile
 from ydisk import YDisk, sanitize_name
 
 load_dotenv()
 
+log = logging.getLogger(__name__)
+
 BOT_TOKEN = os.getenv("BOT_TOKEN")
-ADMIN_IDS = {int(x.strip()) for x in (os.getenv("ADMIN_IDS") or "").split(",") if x.strip().isdigit()}
+# frozenset считается один раз при импорте: is_admin — просто проверка по хэшу
+ADMIN_IDS = frozenset(int(x.strip()) for x in (os.getenv("ADMIN_IDS") or "").split(",") if x.strip().isdigit())
 DB_PATH = os.getenv("DB_PATH", "storage/bot.db")
 
 YANDEX_TOKEN = os.getenv("YANDEX_TOKEN")
@@ -43,19 +61,40 @@ YANDEX_ROOT = (os.getenv("YANDEX_ROOT") or "Фестиваль").strip().strip("
 YANDEX_INBOX = (os.getenv("YANDEX_INBOX") or "INBOX").strip().strip("/")
 YANDEX_LOCAL = (os.getenv("YANDEX_LOCAL") or "Локальные файлы").strip().strip("/")
 
-if not BOT_TOKEN:
-    raise RuntimeError("No BOT_TOKEN in .env")
-if not ADMIN_IDS:
-    raise RuntimeError("No ADMIN_IDS in .env")
-if not YANDEX_TOKEN:
-    raise RuntimeError("No YANDEX_TOKEN in .env")
+# FSM в Redis (общий для нескольких процессов, переживает рестарт); без REDIS_URL — в памяти
+REDIS_URL = (os.getenv("REDIS_URL") or "").strip()
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS") or 50)
+FSM_TTL_SECONDS = int(os.getenv("FSM_TTL_SECONDS") or 30 * 24 * 3600)
 
-db = DB(DB_PATH)
-yd = YDisk(YANDEX_TOKEN)
-router = Router()
+# Telegram режет бота на ~30 сообщений/с — держимся чуть ниже, чтобы не ловить 429
+TG_RATE_PER_SEC = int(os.getenv("TG_RATE_PER_SEC") or 28)
 
-COMMON_DL_MAP: dict[str, str] = {}
-SUB_DL_MAP: dict[str, str] = {}
+# процессы для python-docx (CPU-bound, держит GIL); выгрузки редкие — хватает пары
+DOCX_WORKERS = int(os.getenv("DOCX_WORKERS") or min(2, os.cpu_count() or 1))
+
+# создаются в main(): импорт модуля (в т.ч. процессами DOCX-пула) не трогает БД и Я.Диск
+db: DB
+yd: YDisk
+router = Router()
+# админские хендлеры: доступ проверяется один раз фильтром роутера
+admin_router = Router()
+admin_router.message.filter(F.from_user.id.in_(ADMIN_IDS))
+# «Меню» для всего, что не обработали router и admin_router
+fallback_router = Router()
+
+# token -> (когда выдан, путь на Я.Диске); устаревшие токены убирает dl_sweeper
+COMMON_DL_MAP: dict[str, tuple[float, str]] = {}
+# ограничен по размеру, старые кнопки вытесняются первыми
+SUB_DL_MAP: "OrderedDict[str, tuple[float, str]]" = OrderedDict()
+SUB_DL_MAP_MAX = 4096
+DL_TOKEN_TTL = 3600.0
+DL_SWEEP_INTERVAL = 300.0
+# uid -> (id последней анкеты, готовый текст «Мои ответы»)
+_MY_ANSWERS_CACHE: "OrderedDict[int, Tuple[int, str]]" = OrderedDict()
+_MY_ANSWERS_CACHE_MAX = 1024
+# sub_id -> (updated_at, текст анкеты для админа); LRU, сбрасывается при правке/удалении
+_FORM_TEXT_CACHE: "OrderedDict[int, Tuple[str, str]]" = OrderedDict()
+_FORM_TEXT_CACHE_MAX = 128
 
 INTRO = (
     "Вас приветствует бот осветительного отдела Мастерской «12».\n"
@@ -72,12 +111,29 @@ THANKS = (
 
 DATE_RE = re.compile(r"^\d{2}\.\d{2}\.\d{4}$")
 PHONE_RE = re.compile(r"^[\d\+\-\(\) ]{6,}$")
+WS_RE = re.compile(r"\s+")
+MONTH_BTN_RE = re.compile(r"(\d{4})-(\d{2})")
+SUB_ID_RE = re.compile(r"^#(\d+)")
 
 
 def is_admin(uid: int) -> bool:
     return uid in ADMIN_IDS
 
 
+async def adb(fn: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+    """Run a blocking DB call in a worker thread so the event loop stays free."""
+    return await asyncio.to_thread(fn, *args, **kwargs)
+
+
+# создается в main(); None — run_in_executor берет стандартный пул потоков
+DOCX_POOL: Optional[ProcessPoolExecutor] = None
+
+
+async def run_docx(fn: Callable[..., Any], *args: Any) -> Any:
+    """Run a word.py builder in the docx process pool; args must be picklable."""
+    return await asyncio.get_running_loop().run_in_executor(DOCX_POOL, fn, *args)
+
+
 def norm_date(s: str) -> Optional[str]:
     s = (s or "").strip()
     if not DATE_RE.match(s):
@@ -103,9 +159,10 @@ def norm_phone(s: str) -> Optional[str]:
         return None
     if not PHONE_RE.match(s):
         return None
-    return re.sub(r"\s+", " ", s)
+    return WS_RE.sub(" ", s)
 
 
+@lru_cache(maxsize=1024)
 def folder_for(event_date: str, org: str, event_title: str) -> str:
     return f"{YANDEX_ROOT}/{sanitize_name(event_date)}-{sanitize_name(org)}-{sanitize_name(event_title)}"
 
@@ -135,6 +192,11 @@ def ikb(rows: List[List[Tuple[str, str]]]) -> InlineKeyboardMarkup:
     )
 
 
+# Клавиатуры ниже — чистые функции от маленьких аргументов, поэтому кешируются.
+# aiogram только сериализует markup при отправке, общий объект не меняется.
+
+
+@lru_cache(maxsize=64)
 def kb_inline(field: str, cols: int = 2) -> InlineKeyboardMarkup:
     opts = SURVEY_OPTIONS[field]
     rows: List[List[Tuple[str, str]]] = []
@@ -150,6 +212,11 @@ def kb_inline(field: str, cols: int = 2) -> InlineKeyboardMarkup:
 
 
 def kb_power_types_multi(selected: List[str], none_selected: bool = False) -> InlineKeyboardMarkup:
+    return _kb_power_types_multi(frozenset(selected), bool(none_selected))
+
+
+@lru_cache(maxsize=256)
+def _kb_power_types_multi(selected: FrozenSet[str], none_selected: bool) -> InlineKeyboardMarkup:
     opts = SURVEY_OPTIONS["power_type"]
     rows: List[List[InlineKeyboardButton]] = []
     # ❌ показываем только если пользователь явно выбрал «Нет»
@@ -165,6 +232,11 @@ def kb_power_types_multi(selected: List[str], none_selected: bool = False) -> In
 
 
 def kb_sfx_multi(selected: List[str], none_selected: bool = False) -> InlineKeyboardMarkup:
+    return _kb_sfx_multi(frozenset(selected), bool(none_selected))
+
+
+@lru_cache(maxsize=256)
+def _kb_sfx_multi(selected: FrozenSet[str], none_selected: bool) -> InlineKeyboardMarkup:
     opts = SURVEY_OPTIONS["sfx"]
     rows: List[List[InlineKeyboardButton]] = []
     # ❌ показываем только если пользователь явно выбрал «Нет»
@@ -179,23 +251,39 @@ def kb_sfx_multi(selected: List[str], none_selected: bool = False) -> InlineKeyb
     return InlineKeyboardMarkup(inline_keyboard=rows)
 
 
+@lru_cache(maxsize=1)
 def kb_survey_reply() -> ReplyKeyboardMarkup:
     return ReplyKeyboardMarkup(keyboard=[[KeyboardButton(text="⏸ Прервать и доделать позже")]], resize_keyboard=True)
 
 
-def kb_menu(uid: int) -> ReplyKeyboardMarkup:
+def _build_menu(admin: bool, draft: bool) -> ReplyKeyboardMarkup:
     rows = [
         [KeyboardButton(text="📝 Пройти опрос")],
         [KeyboardButton(text="📁 Документы"), KeyboardButton(text="📄 Мои ответы")],
         [KeyboardButton(text="✏️ Изменить ответы")],
     ]
-    if db.get_draft(uid):
+    if draft:
         rows.insert(1, [KeyboardButton(text="▶️ Продолжить опрос")])
-    if is_admin(uid):
+    if admin:
         rows.insert(0, [KeyboardButton(text="🛠 Админ")])
     return ReplyKeyboardMarkup(keyboard=rows, resize_keyboard=True)
 
 
+# все 4 варианта главного меню строятся один раз: (админ, есть черновик)
+_MENUS: Dict[Tuple[bool, bool], ReplyKeyboardMarkup] = {
+    (admin, draft): _build_menu(admin, draft) for admin in (False, True) for draft in (False, True)
+}
+
+
+async def kb_menu(uid: int) -> ReplyKeyboardMarkup:
+    draft = db.cached_has_draft(uid)
+    if draft is None:
+        # промах кэша (первое меню после рестарта) — запрос в sqlite не на event loop
+        draft = await adb(db.has_draft, uid)
+    return _MENUS[(is_admin(uid), draft)]
+
+
+@lru_cache(maxsize=1)
 def kb_admin_menu() -> ReplyKeyboardMarkup:
     rows = [
         [KeyboardButton(text="📋 Анкеты"), KeyboardButton(text="📊 Статистика")],
@@ -205,105 +293,6 @@ def kb_admin_menu() -> ReplyKeyboardMarkup:
     return ReplyKeyboardMarkup(keyboard=rows, resize_keyboard=True)
 
 
-def answers_text(a: Dict[str, Any]) -> str:
-    def fmt_list(xs: List[str]) -> str:
-        if not xs:
-            return "—"
-        return "\n" + "\n".join([f"  - {x}" for x in xs])
-
-    def g(k: str) -> str:
-        v = a.get(k)
-        if v is None or v == "" or v == []:
-            return "—"
-        if isinstance(v, list):
-            return fmt_list([str(x) for x in v])
-        return str(v)
-
-    power_where = a.get("power_where_list") or []
-    power_type = str(a.get("power_type") or "").strip()
-    power_items = a.get("power_items") or []
-    power_types = a.get("power_types") or []
-
-    if (not power_where) and power_items:
-        flat: List[str] = []
-        for it in power_items:
-            t = (it or {}).get("type")
-            for w in ((it or {}).get("where") or []):
-                if t:
-                    flat.append(f"{t}: {w}")
-        power_where = flat
-
-    if (not power_type) and power_items:
-        power_type = ", ".join([str((it or {}).get("type")) for it in power_items if (it or {}).get("type")])
-
-    if (not power_type) and power_types:
-        power_type = ", ".join([str(x) for x in power_types if x])
-
-    power_needed = "Да"
-    if (not power_where) and (power_type in {"", "—", "Нет", "0"}):
-        power_needed = "Нет"
-    if str(power_type).strip() == "Нет":
-        power_needed = "Нет"
-    if power_needed == "Нет" and (power_types or power_items):
-        power_needed = "Да"
-
-    dimmer_needed = str(a.get("dimmer_needed") or "—").strip()
-
-    sfx_list = a.get("sfx_list")
-    if sfx_list is None:
-        try:
-            sfx_list = json.loads(a.get("sfx_json") or "[]")
-        except Exception:
-            sfx_list = []
-    if not isinstance(sfx_list, list):
-        sfx_list = []
-    sfx_other = str(a.get("sfx_other") or "").strip()
-    if sfx_other and ("Другое" in sfx_list):
-        sfx_list = [x if x != "Другое" else f"Другое: {sfx_other}" for x in sfx_list]
-    a["sfx_list"] = sfx_list
-
-    operator = str(a.get("operator") or "—").strip()
-    console_help = str(a.get("console_help") or "—").strip()
-    scene = str(a.get("scene") or "").strip()
-
-    if operator == "Оператор Мастерской «12»":
-        console_model = "—"
-    else:
-        if console_help == "Привезем свой пульт":
-            console_model = str(a.get("console_model") or "—").strip()
-        else:
-            console_model = "GrandMa2 Light" if scene == "Большой зал" else "Chamsys MQ500"
-
-    lines = [
-        f"1) Организация: {g('org')}",
-        f"2) Должность: {g('role')}",
-        f"3) Имя: {g('name')}",
-        f"4) Телефон: {g('phone')}",
-        f"5) Дата: {g('event_date')}",
-        f"6) Название мероприятия: {g('event_title')}",
-        f"7) Сцена: {g('scene')}",
-        f"8) Ночной монтаж: {g('night_mount')}",
-        f"9) Монтаж: {g('mount_who')}",
-        f"10) Техников: {g('techs_count')}",
-        f"11) Доп. оборудование: {g('extra_equipment')}",
-        f"12) Вилки: {g('plugs')}",
-        f"13) Силовые: {power_needed}",
-        f"14) Где силовые: {fmt_list(power_where) if power_where else '—'}",
-        f"15) Диммер: {dimmer_needed}",
-    ]
-    if dimmer_needed == "Да":
-        lines.append(f"16) Диммер где и сколько: {g('dimmer_text')}")
-    lines.append(f"17) Спецэффекты: {g('sfx_list')}")
-    lines.extend(
-        [
-            f"18) Кто ведет: {operator}",
-            f"19) Помощь с пультом: {console_help}",
-            f"20) Пульт: {console_model}",
-        ]
-    )
-    return "\n".join(lines)
-
-
 EDIT_FIELDS = [
     ("org", "Организация"),
     ("role", "Должность"),
@@ -324,6 +313,7 @@ EDIT_FIELDS = [
     ("console_help", "Помощь с пультом"),
     ("console_model", "Пульт модель"),
 ]
+EDIT_TITLE_TO_KEY: Dict[str, str] = {title: k for k, title in EDIT_FIELDS}
 
 EDIT_OPTIONS: Dict[str, List[str]] = {
     "scene": SURVEY_OPTIONS["scene"],
@@ -334,15 +324,23 @@ EDIT_OPTIONS: Dict[str, List[str]] = {
     "operator": SURVEY_OPTIONS["operator"],
     "console_help": SURVEY_OPTIONS["console_help"],
 }
+# для проверок «значение из списка»; сами списки остаются для клавиатур
+EDIT_OPTIONS_SET: Dict[str, FrozenSet[str]] = {k: frozenset(v) for k, v in EDIT_OPTIONS.items()}
 
 
+@lru_cache(maxsize=1)
 def kb_edit_fields() -> ReplyKeyboardMarkup:
     kb_rows = [[KeyboardButton(text=title)] for _, title in EDIT_FIELDS]
     kb_rows.append([KeyboardButton(text="⬅️ Назад")])
     return ReplyKeyboardMarkup(keyboard=kb_rows, resize_keyboard=True)
 
 
-def kb_reply_options(options: List[str]) -> ReplyKeyboardMarkup:
+def kb_reply_options(options: Sequence[str]) -> ReplyKeyboardMarkup:
+    return _kb_reply_options(tuple(options))
+
+
+@lru_cache(maxsize=64)
+def _kb_reply_options(options: Tuple[str, ...]) -> ReplyKeyboardMarkup:
     kb_rows = [[KeyboardButton(text=o)] for o in options]
     kb_rows.append([KeyboardButton(text="⬅️ Назад")])
     return ReplyKeyboardMarkup(keyboard=kb_rows, resize_keyboard=True)
@@ -402,6 +400,83 @@ class AdminForms(StatesGroup):
     pick_form = State()
 
 
+def _finalize_power(items: List[Dict[str, Any]], types: List[str]) -> Tuple[str, List[str], int]:
+    """Черновик силовых -> (power_type, power_where_list, power_count_sum) для записи в анкету."""
+    if not items and types:
+        items = [{"type": t, "count": 0, "where": []} for t in types]
+    if not items:
+        return "Нет", [], 0
+    power_type = ", ".join([x.get("type") for x in items if x.get("type")])
+    power_where_list = [f"{it.get('type')}: {w}" for it in items for w in (it.get("where") or [])]
+    power_count_sum = sum(int(it.get("count") or 0) for it in items)
+    return power_type, power_where_list, power_count_sum
+
+
+ResumeHandler = Callable[[Message, FSMContext, Dict[str, Any]], Awaitable[Any]]
+
+
+class OutboundRateLimit(BaseRequestMiddleware):
+    """Общий лимит на все исходящие вызовы Bot API (кроме long polling getUpdates)."""
+
+    def __init__(self, rate: int) -> None:
+        self.limiter = AsyncLimiter(rate, 1)
+
+    async def __call__(
+        self,
+        make_request: NextRequestMiddlewareType[TelegramType],
+        bot: Bot,
+        method: TelegramMethod[TelegramType],
+    ) -> Response[TelegramType]:
+        if isinstance(method, GetUpdates):
+            return await make_request(bot, method)
+        async with self.limiter:
+            return await make_request(bot, method)
+
+
+Handler = Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]]
+
+
+class PerChatConcurrency(BaseMiddleware):
+    """Обновления одного чата обрабатываются строго по очереди, разных чатов — параллельно.
+
+    Регистрируется как outer-middleware, поэтому в очередь попадает вся цепочка
+    (фильтры + хендлер), и фильтры по состоянию видят актуальное FSM-состояние.
+    """
+
+    def __init__(self) -> None:
+        self.chat_queues: Dict[int, asyncio.Queue] = {}
+        self._workers: set[asyncio.Task] = set()
+
+    async def __call__(self, handler: Handler, event: TelegramObject, data: Dict[str, Any]) -> Any:
+        chat = data.get("event_chat")
+        user = data.get("event_from_user")
+        key = chat.id if chat else (user.id if user else None)
+        if key is None:
+            return await handler(event, data)
+
+        q = self.chat_queues.get(key)
+        if q is None:
+            q = self.chat_queues[key] = asyncio.Queue()
+            task = asyncio.create_task(self._worker(key, q))
+            self._workers.add(task)
+            task.add_done_callback(self._workers.discard)
+        q.put_nowait((handler, event, data))
+        return None
+
+    async def _worker(self, key: int, q: asyncio.Queue) -> None:
+        while not q.empty():
+            handler, event, data = q.get_nowait()
+            state: Optional[FSMContext] = data.get("state")
+            if state is not None:
+                # raw_state снят при получении апдейта — предыдущий хендлер мог его поменять
+                data["raw_state"] = await state.get_state()
+            try:
+                await handler(event, data)
+            except Exception:
+                log.exception("Update handling failed (chat %s)", key)
+        del self.chat_queues[key]
+
+
 async def draft_get(state: FSMContext) -> Dict[str, Any]:
     d = await state.get_data()
     return d.get("draft") or {}
@@ -414,142 +489,96 @@ async def draft_set(state: FSMContext, patch: Dict[str, Any]) -> Dict[str, Any]:
     return d
 
 
-def _safe_row_get(row: Any, key: str, default: Any = None) -> Any:
-    try:
-        if hasattr(row, "keys") and key in row.keys():
-            return row[key]
-    except Exception:
-        pass
-    return default
+# папки, которые уже создавались на Я.Диске в этом процессе
+_KNOWN_FOLDERS: set[str] = set()
+_FOLDER_LOCKS = KeyedLocks()
 
 
-def submission_to_dict(row: Any) -> Dict[str, Any]:
-    power_where_list = json.loads(_safe_row_get(row, "power_where_json", "[]") or "[]")
-    sfx_json = _safe_row_get(row, "sfx_json", "[]") or "[]"
-    try:
-        sfx_list = json.loads(sfx_json)
-    except Exception:
-        sfx_list = []
-    if not isinstance(sfx_list, list):
-        sfx_list = []
-    sfx_other = _safe_row_get(row, "sfx_other", "") or ""
-    return {
-        "org": row["org"],
-        "role": row["role"],
-        "name": row["name"],
-        "phone": _safe_row_get(row, "phone", "") or "",
-        "event_date": row["event_date"],
-        "event_title": row["event_title"],
-        "scene": row["scene"],
-        "night_mount": row["night_mount"],
-        "mount_who": row["mount_who"],
-        "techs_count": row["techs_count"],
-        "extra_equipment": row["extra_equipment"],
-        "plugs": row["plugs"],
-        "power_type": (row["power_type"] or "Нет"),
-        "power_where_list": power_where_list,
-        "dimmer_needed": row["dimmer_needed"],
-        "dimmer_text": row["dimmer_text"],
-        "sfx_json": sfx_json,
-        "sfx_other": sfx_other,
-        "sfx_list": sfx_list,
-        "operator": row["operator"],
-        "console_help": row["console_help"],
-        "console_model": row["console_model"],
-        "ydisk_folder": row["ydisk_folder"],
-        "id": row["id"],
-        "user_id": row["user_id"],
-    }
-
-
-def build_docx_for_submission(sub: Any) -> bytes:
-    d = Document()
-    p = d.add_paragraph("Анкета участника фестиваля")
-    if p.runs:
-        p.runs[0].font.size = Pt(14)
-
-    d.add_paragraph(f"ID анкеты: {sub['id']}")
-    d.add_paragraph(f"Организация: {sub['org']}")
-    d.add_paragraph(f"Название мероприятия: {sub['event_title']}")
-    d.add_paragraph(f"Дата мероприятия: {sub['event_date']}")
-    d.add_paragraph(f"Сцена: {sub['scene']}")
-    d.add_paragraph("")
-
-    table = d.add_table(rows=1, cols=2)
-    hdr = table.rows[0].cells
-    hdr[0].text = "Вопрос"
-    hdr[1].text = "Ответ"
-
-    def add(q: str, a: str):
-        row = table.add_row().cells
-        row[0].text = q
-        row[1].text = a if (a and str(a).strip()) else "—"
-
-    add("1 Организация", sub["org"])
-    add("2 Должность", sub["role"])
-    add("3 Имя", sub["name"])
-    add("4 Телефон", sub.get("phone", "") or "—")
-    add("5 Дата проведения", sub["event_date"])
-    add("6 Название мероприятия", sub["event_title"])
-    add("7 Сцена", sub["scene"])
-    add("8 Ночной монтаж", sub["night_mount"])
-    add("9 Кто монтирует", sub["mount_who"])
-    add("10 Сколько техников", sub["techs_count"])
-    add("11 Доп. оборудование", sub["extra_equipment"])
-    add("12 Вилки", sub["plugs"])
-
-    power_where_list = json.loads(sub.get("power_where_json") or "[]")
-    power_type = str(sub.get("power_type") or "").strip()
-    power_needed = "Да"
-    if (not power_where_list) and (power_type in {"", "—", "Нет", "0"}):
-        power_needed = "Нет"
-    if power_type == "Нет":
-        power_needed = "Нет"
-    add("13 Силовые подключения", power_needed)
-    add("14 Где силовые", "\n".join(power_where_list) if power_where_list else "—")
-
-    add("15 Диммер", sub["dimmer_needed"])
-    if str(sub["dimmer_needed"]).strip() == "Да":
-        add("16 Диммер где и сколько", sub["dimmer_text"])
+async def ensure_folder_cached(path: str) -> None:
+    if path in _KNOWN_FOLDERS:
+        return
+    # параллельные запросы на одну папку ждут один PUT
+    async with _FOLDER_LOCKS.hold(path):
+        if path not in _KNOWN_FOLDERS:
+            await yd.ensure_folder(path)
+            _KNOWN_FOLDERS.add(path)
 
-    try:
-        sfx_list = json.loads(sub.get("sfx_json") or "[]")
-    except Exception:
-        sfx_list = []
-    if not isinstance(sfx_list, list):
-        sfx_list = []
-    sfx_other = str(sub.get("sfx_other") or "").strip()
-    if sfx_other and ("Другое" in sfx_list):
-        sfx_list = [x if x != "Другое" else f"Другое: {sfx_other}" for x in sfx_list]
-    add("17 Спецэффекты", "\n".join(sfx_list) if sfx_list else "Нет")
-
-    add("18 Кто ведет", sub["operator"])
-    add("19 Помощь с пультом", sub["console_help"])
-    add("20 Пульт", sub["console_model"])
-    add("Папка на Я.Диске", sub["ydisk_folder"])
-
-    d.add_paragraph("")
-    d.add_paragraph("Подпись: ______________________")
-    d.add_paragraph("Расшифровка: __________________")
-
-    buf = BytesIO()
-    d.save(buf)
-    return buf.getvalue()
-
-
-async def put_to_yandex(uid: int, file_name: str, data: bytes) -> str:
-    sub_id, folder = db.get_user_last(uid)
+
+async def ensure_folder_chain(*paths: str) -> None:
+    # родитель должен существовать раньше вложенной папки, поэтому строго по порядку
+    for p in paths:
+        await ensure_folder_cached(p)
+
+
+def forget_folder(path: str) -> None:
+    prefix = path + "/"
+    for p in [p for p in _KNOWN_FOLDERS if p == path or p.startswith(prefix)]:
+        _KNOWN_FOLDERS.discard(p)
+
+
+class _BAWriter:
+    """Приемник для bot.download: копит файл в bytearray без промежуточного BytesIO."""
+
+    def __init__(self) -> None:
+        self.buf = bytearray()
+
+    def write(self, chunk: bytes) -> int:
+        self.buf += chunk
+        return len(chunk)
+
+    def flush(self) -> None:
+        pass
+
+
+async def put_to_yandex(uid: int, file_name: str, data: Union[bytes, bytearray, memoryview]) -> str:
+    sub_id, folder = await adb(db.get_user_last, uid)
     if not folder:
         folder = inbox_for(uid)
-        await yd.ensure_folder(f"{YANDEX_ROOT}")
-        await yd.ensure_folder(f"{YANDEX_ROOT}/{YANDEX_INBOX}")
-        await yd.ensure_folder(folder)
+        await ensure_folder_cached(f"{YANDEX_ROOT}")
+        await ensure_folder_cached(f"{YANDEX_ROOT}/{YANDEX_INBOX}")
+        await ensure_folder_cached(folder)
     disk_path = f"{folder}/{sanitize_name(file_name)}"
     await yd.upload_bytes(disk_path, data, overwrite=True)
-    db.save_doc(uid, sub_id, sanitize_name(file_name), disk_path)
+    await adb(db.save_doc, uid, sub_id, sanitize_name(file_name), disk_path)
     return disk_path
 
 
+# ссылки на фоновые задачи, чтобы их не собрал GC до завершения
+_BACKGROUND: set[asyncio.Task] = set()
+
+
+def spawn(coro: Awaitable[Any]) -> asyncio.Task:
+    task = asyncio.ensure_future(coro)
+    _BACKGROUND.add(task)
+    task.add_done_callback(_BACKGROUND.discard)
+    return task
+
+
+async def upload_submission_docx(uid: int, sub_id: int, payload: Dict[str, Any], folder: str) -> None:
+    """Автогенерация Word по сохраненной анкете и загрузка в папку анкеты."""
+    try:
+        sub_for_doc = dict(payload)
+        sub_for_doc["id"] = sub_id
+        sub_for_doc["user_id"] = uid
+        sub_for_doc["ydisk_folder"] = folder
+
+        # нормализуем console_model как в админ-выгрузке
+        sub_for_doc["console_model"] = resolve_console_model(sub_for_doc)
+
+        # python-docx — CPU-bound, не держим им event loop
+        docx_data = await run_docx(build_docx_for_submission, sub_for_doc)
+        docx_name = (
+            f"анкета_{sub_id}_"
+            f"{sanitize_name(sub_for_doc['event_date'])}_"
+            f"{sanitize_name(sub_for_doc['org'])}_"
+            f"{sanitize_name(sub_for_doc['event_title'])}.docx"
+        )
+        await put_to_yandex(uid, docx_name, docx_data)
+    except Exception:
+        # не валим сохранение анкеты из-за docx
+        log.exception("Submission #%s: docx upload failed", sub_id)
+
+
 async def download_and_send(message: Message, ydisk_path: str):
     href = await yd.get_download_url(ydisk_path)
     if not href:
@@ -563,15 +592,110 @@ async def download_and_send(message: Message, ydisk_path: str):
     await message.answer_document(BufferedInputFile(data, filename=name))
 
 
+def _resume_prompt(text: str, kb: Callable[[], Any]) -> ResumeHandler:
+    async def send(message: Message, state: FSMContext, d: Dict[str, Any]):
+        return await message.answer(text, reply_markup=kb())
+    return send
+
+
+async def _resume_power_type(message: Message, state: FSMContext, d: Dict[str, Any]):
+    sel = d.get("power_types") or []
+    none_selected = bool(d.get("power_none"))
+    return await message.answer(
+        "12) Выберите один или несколько вариантов и нажмите «➡️ Далее»:",
+        reply_markup=kb_power_types_multi(sel, none_selected=none_selected),
+    )
+
+
+async def _resume_power_count(message: Message, state: FSMContext, d: Dict[str, Any]):
+    items = d.get("power_items") or []
+    i = int(d.get("power_i") or 0)
+    cur = items[i]["type"] if i < len(items) else ""
+    return await message.answer(f"13) Сколько подключений нужно для «{cur}»?", reply_markup=kb_survey_reply())
+
+
+async def _resume_power_where(message: Message, state: FSMContext, d: Dict[str, Any]):
+    items = d.get("power_items") or []
+    i = int(d.get("power_i") or 0)
+    if i >= len(items):
+        await state.set_state(Survey.dimmer_needed)
+        return await message.answer("15) Нужен ли диммер?", reply_markup=kb_inline("dimmer_needed", 2))
+    cur = items[i]
+    need = int(cur.get("count") or 0)
+    got = len(cur.get("where") or [])
+    left = max(need - got, 0)
+    txt = f"14) Где нужны подключения для «{cur['type']}»?"
+    if got > 0:
+        txt += f" Осталось {left}"
+    return await message.answer(txt, reply_markup=kb_inline("power_where", 2))
+
+
+async def _resume_sfx(message: Message, state: FSMContext, d: Dict[str, Any]):
+    sel = d.get("sfx_list") or []
+    none_selected = bool(d.get("sfx_none"))
+    return await message.answer(
+        "17) Выберите один или несколько вариантов и нажмите «➡️ Далее»:",
+        reply_markup=kb_sfx_multi(sel, none_selected=none_selected),
+    )
+
+
+async def _resume_console_help(message: Message, state: FSMContext, d: Dict[str, Any]):
+    console_name = venue_console(d.get("scene"))
+    return await message.answer(
+        f"19) Мы используем пульт {console_name}. Нужна помощь с пультом?",
+        reply_markup=kb_inline("console_help", 1),
+    )
+
+
+async def _resume_confirm(message: Message, state: FSMContext, d: Dict[str, Any]):
+    return await message.answer("Проверьте:\n\n" + answers_text(d), reply_markup=kb_inline("confirm", 2))
+
+
+# состояние опроса -> как повторно задать вопрос при «▶️ Продолжить опрос»
+RESUME_TABLE: Dict[str, ResumeHandler] = {
+    Survey.org.state: _resume_prompt("1) Как называется ваша организация?", kb_survey_reply),
+    Survey.role.state: _resume_prompt("2) Ваша должность?", kb_survey_reply),
+    Survey.name.state: _resume_prompt("3) Ваше имя?", kb_survey_reply),
+    Survey.event_date.state: _resume_prompt("4) Дата проведения мероприятия? (ДД.ММ.ГГГГ)", kb_survey_reply),
+    Survey.event_title.state: _resume_prompt("5) Название мероприятия?", kb_survey_reply),
+    Survey.scene.state: _resume_prompt(
+        "6) На какой сцене будет проходить мероприятие?", lambda: kb_inline("scene", 2)
+    ),
+    Survey.night_mount.state: _resume_prompt(
+        "7) Нужен ли ночной монтаж перед мероприятием?", lambda: kb_inline("night_mount", 2)
+    ),
+    Survey.mount_who.state: _resume_prompt(
+        "8) Кто производит монтаж световой аппаратуры?", lambda: kb_inline("mount_who", 1)
+    ),
+    Survey.techs_count.state: _resume_prompt("9) Сколько техников на монтаж понадобится? (число)", kb_survey_reply),
+    Survey.extra_equipment.state: _resume_prompt(
+        "10) Используете ли доп. световое оборудование?", lambda: kb_inline("extra_equipment", 1)
+    ),
+    Survey.plugs.state: _resume_prompt("11) Какие вилки на ваших приборах?", kb_survey_reply),
+    Survey.power_type.state: _resume_power_type,
+    Survey.power_count.state: _resume_power_count,
+    Survey.power_where.state: _resume_power_where,
+    Survey.dimmer_needed.state: _resume_prompt("15) Нужен ли диммер?", lambda: kb_inline("dimmer_needed", 2)),
+    Survey.dimmer_text.state: _resume_prompt("16) Диммер: где и сколько?", kb_survey_reply),
+    Survey.sfx.state: _resume_sfx,
+    Survey.sfx_other.state: _resume_prompt("Введите свой вариант спецэффектов:", kb_survey_reply),
+    Survey.operator.state: _resume_prompt("18) Кто ведет мероприятие?", lambda: kb_inline("operator", 1)),
+    Survey.console_help.state: _resume_console_help,
+    Survey.console_model.state: _resume_prompt("20) Марка и модель вашего пульта? (текст)", kb_survey_reply),
+    Survey.phone.state: _resume_prompt("21) Номер телефона для связи?", kb_survey_reply),
+    Survey.confirm.state: _resume_confirm,
+}
+
+
 @router.message(CommandStart())
 async def start(message: Message, state: FSMContext):
     await state.clear()
-    await message.answer(INTRO, reply_markup=kb_menu(message.from_user.id))
+    await message.answer(INTRO, reply_markup=await kb_menu(message.from_user.id))
 
 
 @router.message(F.text == "📝 Пройти опрос")
 async def m_survey(message: Message, state: FSMContext):
-    if db.get_draft(message.from_user.id):
+    if await adb(db.get_draft, message.from_user.id):
         kb = ReplyKeyboardMarkup(
             keyboard=[
                 [KeyboardButton(text="▶️ Продолжить опрос"), KeyboardButton(text="🆕 Начать заново")],
@@ -594,7 +718,7 @@ async def m_survey(message: Message, state: FSMContext):
 
 @router.message(F.text == "🆕 Начать заново")
 async def m_new(message: Message, state: FSMContext):
-    db.delete_draft(message.from_user.id)
+    await adb(db.delete_draft, message.from_user.id)
     await state.clear()
     await draft_set(
         state,
@@ -607,14 +731,14 @@ async def m_new(message: Message, state: FSMContext):
 
 @router.message(F.text == "▶️ Продолжить опрос")
 async def m_resume(message: Message, state: FSMContext):
-    row = db.get_draft(message.from_user.id)
+    row = await adb(db.get_draft, message.from_user.id)
     if not row:
-        await message.answer("Черновика нет.", reply_markup=kb_menu(message.from_user.id))
+        await message.answer("Черновика нет.", reply_markup=await kb_menu(message.from_user.id))
         return
 
     await state.clear()
     try:
-        d = json.loads(row["draft_json"])
+        d = json_loads(row["draft_json"])
     except Exception:
         d = {"power_types": [], "power_items": [], "power_i": 0, "sfx_list": [], "sfx_other": ""}
     d.setdefault("power_none", False)
@@ -624,123 +748,66 @@ async def m_resume(message: Message, state: FSMContext):
     st = row["fsm_state"]
     d2 = await draft_get(state)
 
-    if st == Survey.org.state:
-        return await message.answer("1) Как называется ваша организация?", reply_markup=kb_survey_reply())
-    if st == Survey.role.state:
-        return await message.answer("2) Ваша должность?", reply_markup=kb_survey_reply())
-    if st == Survey.name.state:
-        return await message.answer("3) Ваше имя?", reply_markup=kb_survey_reply())
-    if st == Survey.event_date.state:
-        return await message.answer("4) Дата проведения мероприятия? (ДД.ММ.ГГГГ)", reply_markup=kb_survey_reply())
-    if st == Survey.event_title.state:
-        return await message.answer("5) Название мероприятия?", reply_markup=kb_survey_reply())
-    if st == Survey.scene.state:
-        return await message.answer("6) На какой сцене будет проходить мероприятие?", reply_markup=kb_inline("scene", 2))
-    if st == Survey.night_mount.state:
-        return await message.answer("7) Нужен ли ночной монтаж перед мероприятием?", reply_markup=kb_inline("night_mount", 2))
-    if st == Survey.mount_who.state:
-        return await message.answer("8) Кто производит монтаж световой аппаратуры?", reply_markup=kb_inline("mount_who", 1))
-    if st == Survey.techs_count.state:
-        return await message.answer("9) Сколько техников на монтаж понадобится? (число)", reply_markup=kb_survey_reply())
-    if st == Survey.extra_equipment.state:
-        return await message.answer("10) Используете ли доп. световое оборудование?", reply_markup=kb_inline("extra_equipment", 1))
-    if st == Survey.plugs.state:
-        return await message.answer("11) Какие вилки на ваших приборах?", reply_markup=kb_survey_reply())
-    if st == Survey.power_type.state:
-        sel = d2.get("power_types") or []
-        none_selected = bool(d2.get("power_none"))
-        return await message.answer(
-            "12) Выберите один или несколько вариантов и нажмите «➡️ Далее»:",
-            reply_markup=kb_power_types_multi(sel, none_selected=none_selected),
-        )
-    if st == Survey.power_count.state:
-        items = d2.get("power_items") or []
-        i = int(d2.get("power_i") or 0)
-        cur = items[i]["type"] if i < len(items) else ""
-        return await message.answer(f"13) Сколько подключений нужно для «{cur}»?", reply_markup=kb_survey_reply())
-    if st == Survey.power_where.state:
-        items = d2.get("power_items") or []
-        i = int(d2.get("power_i") or 0)
-        if i >= len(items):
-            await state.set_state(Survey.dimmer_needed)
-            return await message.answer("15) Нужен ли диммер?", reply_markup=kb_inline("dimmer_needed", 2))
-        cur = items[i]
-        need = int(cur.get("count") or 0)
-        got = len(cur.get("where") or [])
-        left = max(need - got, 0)
-        txt = f"14) Где нужны подключения для «{cur['type']}»?"
-        if got > 0:
-            txt += f" Осталось {left}"
-        return await message.answer(txt, reply_markup=kb_inline("power_where", 2))
-    if st == Survey.dimmer_needed.state:
-        return await message.answer("15) Нужен ли диммер?", reply_markup=kb_inline("dimmer_needed", 2))
-    if st == Survey.dimmer_text.state:
-        return await message.answer("16) Диммер: где и сколько?", reply_markup=kb_survey_reply())
-    if st == Survey.sfx.state:
-        sel = d2.get("sfx_list") or []
-        none_selected = bool(d2.get("sfx_none"))
-        return await message.answer(
-            "17) Выберите один или несколько вариантов и нажмите «➡️ Далее»:",
-            reply_markup=kb_sfx_multi(sel, none_selected=none_selected),
-        )
-    if st == Survey.sfx_other.state:
-        return await message.answer("Введите свой вариант спецэффектов:", reply_markup=kb_survey_reply())
-    if st == Survey.operator.state:
-        return await message.answer("18) Кто ведет мероприятие?", reply_markup=kb_inline("operator", 1))
-    if st == Survey.console_help.state:
-        console_name = "GrandMa2 Light" if d2.get("scene") == "Большой зал" else "Chamsys MQ500"
-        return await message.answer(
-            f"19) Мы используем пульт {console_name}. Нужна помощь с пультом?",
-            reply_markup=kb_inline("console_help", 1),
-        )
-    if st == Survey.console_model.state:
-        return await message.answer("20) Марка и модель вашего пульта? (текст)", reply_markup=kb_survey_reply())
-    if st == Survey.phone.state:
-        return await message.answer("21) Номер телефона для связи?", reply_markup=kb_survey_reply())
-    if st == Survey.confirm.state:
-        return await message.answer("Проверьте:\n\n" + answers_text(d2), reply_markup=kb_inline("confirm", 2))
+    resume = RESUME_TABLE.get(st)
+    if resume:
+        return await resume(message, state, d2)
 
     await state.clear()
-    await message.answer("Меню:", reply_markup=kb_menu(message.from_user.id))
+    await message.answer("Меню:", reply_markup=await kb_menu(message.from_user.id))
 
 
 @router.message(F.text == "📁 Документы")
 async def m_docs(message: Message):
     common_path = f"{YANDEX_ROOT}/{YANDEX_LOCAL}"
-    try:
-        common = await yd.list_files(common_path, limit=30)
-    except Exception:
+    # Я.Диск и локальная БД независимы — опрашиваем параллельно
+    common, personal = await asyncio.gather(
+        yd.list_files(common_path, limit=30),
+        adb(db.list_docs, message.from_user.id, limit=30),
+        return_exceptions=True,
+    )
+    if isinstance(common, BaseException):
         common = []
-
-    personal = db.list_docs(message.from_user.id, limit=30)
+    if isinstance(personal, BaseException):
+        raise personal
 
     text = ["📁 Файлы Мастерской '12':"]
     text += [f"- {x['name']}" for x in common] if common else ["- (пусто)"]
     text += ["", "📁 Ваши файлы:"]
     text += [f"- {d['file_name']}" for d in personal] if personal else ["- (пусто)"]
 
-    await message.answer("\n".join(text), reply_markup=kb_menu(message.from_user.id))
+    if not common and not personal:
+        await message.answer("\n".join(text), reply_markup=await kb_menu(message.from_user.id))
+        return
 
+    # один ответ: список + кнопки скачивания, разделенные заголовками
+    kb_rows: List[List[InlineKeyboardButton]] = []
     if common:
-        kb_rows = []
+        kb_rows.append([InlineKeyboardButton(text="— Файлы Мастерской '12' —", callback_data="noop")])
+        issued = time.monotonic()
         for x in common:
             token = os.urandom(6).hex()
-            COMMON_DL_MAP[token] = x["path"]
+            COMMON_DL_MAP[token] = (issued, x["path"])
             kb_rows.append([InlineKeyboardButton(text=f"⬇️ {x['name']}", callback_data=f"dlc:{token}")])
-        await message.answer("Файлы Мастерской '12' — скачать:", reply_markup=InlineKeyboardMarkup(inline_keyboard=kb_rows))
-
     if personal:
-        kb_rows = [[InlineKeyboardButton(text=f"⬇️ {d['file_name']}", callback_data=f"dlp:{d['id']}")] for d in personal]
-        await message.answer("Ваши файлы — скачать:", reply_markup=InlineKeyboardMarkup(inline_keyboard=kb_rows))
+        kb_rows.append([InlineKeyboardButton(text="— Ваши файлы —", callback_data="noop")])
+        kb_rows += [[InlineKeyboardButton(text=f"⬇️ {d['file_name']}", callback_data=f"dlp:{d['id']}")] for d in personal]
+
+    await message.answer("\n".join(text), reply_markup=InlineKeyboardMarkup(inline_keyboard=kb_rows))
+
+
+@router.callback_query(F.data == "noop")
+async def noop_cb(call: CallbackQuery):
+    await call.answer()
 
 
 @router.callback_query(F.data.startswith("dlc:"))
 async def dl_common(call: CallbackQuery):
     token = call.data.split(":", 1)[1]
-    path = COMMON_DL_MAP.get(token)
-    if not path:
+    entry = COMMON_DL_MAP.get(token)
+    if not entry:
         await call.answer("Кнопка устарела", show_alert=True)
         return
+    path = entry[1]
     await call.answer("Скачиваю...")
     try:
         await download_and_send(call.message, path)
@@ -752,16 +819,9 @@ async def dl_common(call: CallbackQuery):
 async def dl_personal(call: CallbackQuery):
     doc_id = int(call.data.split(":", 1)[1])
 
-    row = None
-    docs = db.list_docs(call.from_user.id, limit=500)
-    for d in docs:
-        if int(d["id"]) == doc_id:
-            row = d
-            break
-
-    if row is None and is_admin(call.from_user.id):
-        with db._conn() as con:
-            row = con.execute("SELECT * FROM docs WHERE id=?", (doc_id,)).fetchone()
+    row = await adb(db.get_doc, doc_id)
+    if row is not None and int(row["user_id"]) != call.from_user.id and not is_admin(call.from_user.id):
+        row = None
 
     if not row:
         await call.answer("Не найдено", show_alert=True)
@@ -774,10 +834,11 @@ async def dl_personal(call: CallbackQuery):
 @router.callback_query(F.data.startswith("dls:"))
 async def dl_submission_file(call: CallbackQuery):
     token = call.data.split(":", 1)[1]
-    path = SUB_DL_MAP.get(token)
-    if not path:
+    entry = SUB_DL_MAP.get(token)
+    if not entry:
         await call.answer("Кнопка устарела", show_alert=True)
         return
+    path = entry[1]
     await call.answer("Скачиваю...")
     try:
         await download_and_send(call.message, path)
@@ -785,21 +846,45 @@ async def dl_submission_file(call: CallbackQuery):
         SUB_DL_MAP.pop(token, None)
 
 
+def sweep_dl_tokens(now: float) -> None:
+    cutoff = now - DL_TOKEN_TTL
+    for dl_map in (COMMON_DL_MAP, SUB_DL_MAP):
+        for token in [t for t, (issued, _) in dl_map.items() if issued < cutoff]:
+            del dl_map[token]
+
+
+async def dl_sweeper() -> None:
+    """Periodically drop download tokens older than DL_TOKEN_TTL."""
+    while True:
+        await asyncio.sleep(DL_SWEEP_INTERVAL)
+        sweep_dl_tokens(time.monotonic())
+
+
 @router.message(F.text == "📄 Мои ответы")
 async def m_my(message: Message):
-    last = db.get_last_submission_by_user(message.from_user.id)
+    last = await adb(db.get_last_submission_by_user, message.from_user.id)
     if not last:
-        await message.answer("Ответов нет. Нажмите «📝 Пройти опрос».", reply_markup=kb_menu(message.from_user.id))
+        await message.answer("Ответов нет. Нажмите «📝 Пройти опрос».", reply_markup=await kb_menu(message.from_user.id))
         return
-    a = submission_to_dict(last)
-    await message.answer("📄 Последняя анкета:\n\n" + answers_text(a), reply_markup=kb_menu(message.from_user.id))
+    uid = message.from_user.id
+    cached = _MY_ANSWERS_CACHE.get(uid)
+    if cached and cached[0] == int(last["id"]):
+        text = cached[1]
+        _MY_ANSWERS_CACHE.move_to_end(uid)
+    else:
+        text = answers_text(submission_to_dict(last))
+        _MY_ANSWERS_CACHE[uid] = (int(last["id"]), text)
+        _MY_ANSWERS_CACHE.move_to_end(uid)
+        if len(_MY_ANSWERS_CACHE) > _MY_ANSWERS_CACHE_MAX:
+            _MY_ANSWERS_CACHE.popitem(last=False)
+    await message.answer("📄 Последняя анкета:\n\n" + text, reply_markup=await kb_menu(message.from_user.id))
 
 
 @router.message(F.text == "✏️ Изменить ответы")
 async def m_edit(message: Message, state: FSMContext):
-    last = db.get_last_submission_by_user(message.from_user.id)
+    last = await adb(db.get_last_submission_by_user, message.from_user.id)
     if not last:
-        await message.answer("Ответов нет. Сначала пройдите опрос.", reply_markup=kb_menu(message.from_user.id))
+        await message.answer("Ответов нет. Сначала пройдите опрос.", reply_markup=await kb_menu(message.from_user.id))
         return
     await state.clear()
     await state.update_data(edit_sub_id=int(last["id"]))
@@ -818,75 +903,76 @@ async def m_admin(message: Message, state: FSMContext):
 @router.message(F.text == "⬅️ Назад")
 async def m_back(message: Message, state: FSMContext):
     await state.clear()
-    await message.answer("Меню:", reply_markup=kb_menu(message.from_user.id))
+    await message.answer("Меню:", reply_markup=await kb_menu(message.from_user.id))
 
 
 @router.message(F.document)
 async def on_doc(message: Message, bot: Bot):
-    b = BytesIO()
-    await bot.download(message.document, destination=b)
+    w = _BAWriter()
+    await bot.download(message.document, destination=w, seek=False)
     disk_path = await put_to_yandex(
         message.from_user.id,
         message.document.file_name or f"file_{message.document.file_unique_id}",
-        b.getvalue(),
+        memoryview(w.buf),
     )
-    await message.answer(f"✅ Сохранено на Я.Диск:\n{disk_path}", reply_markup=kb_menu(message.from_user.id))
+    await message.answer(f"✅ Сохранено на Я.Диск:\n{disk_path}", reply_markup=await kb_menu(message.from_user.id))
 
 
 @router.message(F.photo)
 async def on_photo(message: Message, bot: Bot):
     ph = message.photo[-1]
-    b = BytesIO()
-    await bot.download(ph, destination=b)
-    disk_path = await put_to_yandex(message.from_user.id, f"photo_{ph.file_unique_id}.jpg", b.getvalue())
-    await message.answer(f"✅ Сохранено на Я.Диск:\n{disk_path}", reply_markup=kb_menu(message.from_user.id))
+    w = _BAWriter()
+    await bot.download(ph, destination=w, seek=False)
+    disk_path = await put_to_yandex(message.from_user.id, f"photo_{ph.file_unique_id}.jpg", memoryview(w.buf))
+    await message.answer(f"✅ Сохранено на Я.Диск:\n{disk_path}", reply_markup=await kb_menu(message.from_user.id))
+
+
+_PAUSABLE_PREFIXES = ("Survey:", "EditPower:")
 
 
 @router.message(F.text == "⏸ Прервать и доделать позже")
 async def survey_pause_reply(message: Message, state: FSMContext):
     st = await state.get_state()
-    if not st or (not st.startswith("Survey:") and not st.startswith("EditPower:")):
-        await message.answer("Опрос сейчас не идет.", reply_markup=kb_menu(message.from_user.id))
+    if not st or not st.startswith(_PAUSABLE_PREFIXES):
+        await message.answer("Опрос сейчас не идет.", reply_markup=await kb_menu(message.from_user.id))
         return
-    if st.startswith("EditPower:"):
-        await message.answer("Сначала завершите изменение «Силовые подключения».", reply_markup=kb_menu(message.from_user.id))
+    if not st.startswith("Survey:"):
+        await message.answer("Сначала завершите изменение «Силовые подключения».", reply_markup=await kb_menu(message.from_user.id))
         return
     d = await draft_get(state)
-    db.upsert_draft(message.from_user.id, st, json.dumps(d, ensure_ascii=False))
+    await adb(db.upsert_draft, message.from_user.id, st, json_dumps(d))
     await state.clear()
-    await message.answer("✅ Сохранено. Продолжить: «▶️ Продолжить опрос».", reply_markup=kb_menu(message.from_user.id))
+    await message.answer("✅ Сохранено. Продолжить: «▶️ Продолжить опрос».", reply_markup=await kb_menu(message.from_user.id))
 
 
 @router.message(Edit.pick)
 async def edit_pick(message: Message, state: FSMContext):
     if message.text == "⬅️ Назад":
         await state.clear()
-        await message.answer("Меню:", reply_markup=kb_menu(message.from_user.id))
+        await message.answer("Меню:", reply_markup=await kb_menu(message.from_user.id))
         return
 
-    field = None
-    for k, title in EDIT_FIELDS:
-        if title == message.text:
-            field = k
-            break
+    field = EDIT_TITLE_TO_KEY.get(message.text or "")
     if not field:
         await message.answer("Выберите поле кнопкой.")
         return
 
     if field == "power_block":
         sub_id = (await state.get_data()).get("edit_sub_id")
-        row = db.get_submission(int(sub_id)) if sub_id else None
+        row = await adb(db.get_submission, int(sub_id)) if sub_id else None
         if not row:
             await state.clear()
-            await message.answer("Меню:", reply_markup=kb_menu(message.from_user.id))
+            await message.answer("Меню:", reply_markup=await kb_menu(message.from_user.id))
             return
 
-        power_where_list = json.loads((row["power_where_json"] or "[]"))
-        items_map: Dict[str, List[str]] = {}
-        for s in power_where_list:
-            if isinstance(s, str) and ": " in s:
-                t, w = s.split(": ", 1)
-                items_map.setdefault(t, []).append(w)
+        power_where_list = json_loads((row["power_where_json"] or "[]"))
+        if not isinstance(power_where_list, list):
+            power_where_list = []
+        # "тип: где" -> {тип: [где, ...]} в порядке первого появления типа
+        items_map: DefaultDict[str, List[str]] = defaultdict(list)
+        for t, sep, w in (s.partition(": ") for s in power_where_list if isinstance(s, str)):
+            if sep:
+                items_map[t].append(w)
         power_types = list(items_map.keys())
         power_items = [{"type": t, "count": len(ws), "where": list(ws)} for t, ws in items_map.items()]
 
@@ -921,7 +1007,7 @@ async def edit_value(message: Message, state: FSMContext):
     field = data.get("edit_field")
     if not sub_id or not field:
         await state.clear()
-        await message.answer("Меню:", reply_markup=kb_menu(message.from_user.id))
+        await message.answer("Меню:", reply_markup=await kb_menu(message.from_user.id))
         return
 
     txt = (message.text or "").strip()
@@ -931,7 +1017,8 @@ async def edit_value(message: Message, state: FSMContext):
         await message.answer("Что изменить?", reply_markup=kb_edit_fields())
         return
 
-    if field in EDIT_OPTIONS and txt not in EDIT_OPTIONS[field]:
+    allowed = EDIT_OPTIONS_SET.get(field)
+    if allowed is not None and txt not in allowed:
         await message.answer("Выберите значение кнопкой.")
         return
 
@@ -971,20 +1058,23 @@ async def edit_value(message: Message, state: FSMContext):
         patch["console_model"] = "—"
 
     if field in {"org", "event_date", "event_title"}:
-        row = db.get_submission(int(sub_id))
+        row = await adb(db.get_submission, int(sub_id))
         if row:
             org = patch.get("org") or row["org"]
             event_date = patch.get("event_date") or row["event_date"]
             event_title = patch.get("event_title") or row["event_title"] or "Мероприятие"
             new_folder = folder_for(event_date, org, event_title)
-            await yd.ensure_folder(f"{YANDEX_ROOT}")
-            await yd.ensure_folder(new_folder)
+            await ensure_folder_cached(f"{YANDEX_ROOT}")
+            await ensure_folder_cached(new_folder)
             patch["ydisk_folder"] = new_folder
-            db.upsert_user_last(message.from_user.id, int(sub_id), new_folder)
+            await adb(db.upsert_user_last, message.from_user.id, int(sub_id), new_folder)
 
-    ok = db.update_submission(int(sub_id), patch)
+    ok = await adb(db.update_submission, int(sub_id), patch)
+    _MY_ANSWERS_CACHE.pop(message.from_user.id, None)
+    _FORM_TEXT_CACHE.pop(int(sub_id), None)
+    forget_month_forms()
     await state.clear()
-    await message.answer("✅ Обновлено" if ok else "Не удалось обновить", reply_markup=kb_menu(message.from_user.id))
+    await message.answer("✅ Обновлено" if ok else "Не удалось обновить", reply_markup=await kb_menu(message.from_user.id))
 
 
 @router.message(Survey.org)
@@ -1039,9 +1129,8 @@ async def s_techs(message: Message, state: FSMContext):
 
 @router.message(Survey.plugs)
 async def s_plugs(message: Message, state: FSMContext):
-    await draft_set(state, {"plugs": (message.text or "").strip()})
+    d = await draft_set(state, {"plugs": (message.text or "").strip()})
     await state.set_state(Survey.power_type)
-    d = await draft_get(state)
     sel = d.get("power_types") or []
     none_selected = bool(d.get("power_none"))
     await message.answer(
@@ -1076,10 +1165,10 @@ async def s_power_count(message: Message, state: FSMContext):
 
 @router.message(Survey.dimmer_text)
 async def s_dimmer_text(message: Message, state: FSMContext):
-    await draft_set(state, {"dimmer_text": (message.text or "").strip()})
+    d = await draft_set(state, {"dimmer_text": (message.text or "").strip()})
     await state.set_state(Survey.sfx)
-    sel = (await draft_get(state)).get("sfx_list") or []
-    none_selected = bool((await draft_get(state)).get("sfx_none"))
+    sel = d.get("sfx_list") or []
+    none_selected = bool(d.get("sfx_none"))
     await message.answer(
         "17) Выберите один или несколько вариантов и нажмите «➡️ Далее»:",
         reply_markup=kb_sfx_multi(sel, none_selected=none_selected),
@@ -1099,9 +1188,8 @@ async def s_phone(message: Message, state: FSMContext):
     if not ph:
         await message.answer("Введите телефон (например: +7 999 123-45-67)", reply_markup=kb_survey_reply())
         return
-    await draft_set(state, {"phone": ph})
+    d2 = await draft_set(state, {"phone": ph})
     await state.set_state(Survey.confirm)
-    d2 = await draft_get(state)
     await message.answer("Проверьте:\n\n" + answers_text(d2), reply_markup=kb_inline("confirm", 2))
 
 
@@ -1136,6 +1224,26 @@ async def ep_power_count(message: Message, state: FSMContext):
     await message.answer(f"Где нужны подключения для «{items[i]['type']}»?", reply_markup=kb_inline("power_where", 2))
 
 
+# (chat_id, message_id) -> последнее отправленное состояние мультивыбора
+_LAST_MARKUP: "OrderedDict[Tuple[int, int], Tuple[Any, ...]]" = OrderedDict()
+_LAST_MARKUP_MAX = 2048
+
+
+async def edit_markup_if_changed(call: CallbackQuery, sig: Tuple[Any, ...], markup: InlineKeyboardMarkup) -> None:
+    key = (call.message.chat.id, call.message.message_id)
+    if _LAST_MARKUP.get(key) == sig:
+        return
+    try:
+        await call.message.edit_reply_markup(reply_markup=markup)
+    except TelegramBadRequest as e:
+        if "message is not modified" not in str(e):
+            raise
+    _LAST_MARKUP[key] = sig
+    _LAST_MARKUP.move_to_end(key)
+    if len(_LAST_MARKUP) > _LAST_MARKUP_MAX:
+        _LAST_MARKUP.popitem(last=False)
+
+
 @router.callback_query(F.data.startswith("pt:"))
 async def power_types_cb(call: CallbackQuery, state: FSMContext):
     st = await state.get_state()
@@ -1150,19 +1258,13 @@ async def power_types_cb(call: CallbackQuery, state: FSMContext):
     if call.data == "pt:none":
         sel = []
         await draft_set(state, {"power_types": sel, "power_items": [], "power_i": 0, "power_none": True})
-        try:
-            await call.message.edit_reply_markup(reply_markup=kb_power_types_multi(sel, none_selected=True))
-        except TelegramBadRequest as e:
-            if "message is not modified" not in str(e):
-                raise
+        await edit_markup_if_changed(call, ("pt", tuple(sel), True), kb_power_types_multi(sel, none_selected=True))
         await call.answer()
         return
 
     if call.data == "pt:done":
-        await draft_set(state, {"power_types": sel})
-
         if not sel:
-            await draft_set(state, {"power_items": [], "power_i": 0})
+            await draft_set(state, {"power_types": sel, "power_items": [], "power_i": 0})
             if st == EditPower.power_type.state:
                 await state.set_state(EditPower.confirm)
                 await call.message.answer("Силовые подключения: Нет. Сохранить?", reply_markup=kb_inline("confirm", 2))
@@ -1173,15 +1275,15 @@ async def power_types_cb(call: CallbackQuery, state: FSMContext):
             return
 
         items = [{"type": t, "count": 0, "where": []} for t in sel]
-        await draft_set(state, {"power_items": items, "power_i": 0})
+        await draft_set(state, {"power_types": sel, "power_items": items, "power_i": 0})
         await state.set_state(EditPower.power_count if st == EditPower.power_type.state else Survey.power_count)
         await call.message.answer(f"13) Сколько подключений нужно для «{items[0]['type']}»?", reply_markup=kb_survey_reply())
         await call.answer()
         return
 
-    m = re.match(r"^pt:opt:(\d+)$", call.data)
-    if m:
-        idx = int(m.group(1))
+    idx_s = call.data[len("pt:opt:"):] if call.data.startswith("pt:opt:") else ""
+    if idx_s.isdecimal():
+        idx = int(idx_s)
         if 0 <= idx < len(opts):
             val = opts[idx]
             if val != "Нет":
@@ -1190,11 +1292,7 @@ async def power_types_cb(call: CallbackQuery, state: FSMContext):
                 else:
                     sel.append(val)
         await draft_set(state, {"power_types": sel, "power_none": False})
-        try:
-            await call.message.edit_reply_markup(reply_markup=kb_power_types_multi(sel, none_selected=False))
-        except TelegramBadRequest as e:
-            if "message is not modified" not in str(e):
-                raise
+        await edit_markup_if_changed(call, ("pt", tuple(sel), False), kb_power_types_multi(sel, none_selected=False))
         await call.answer()
         return
 
@@ -1215,16 +1313,11 @@ async def sfx_cb(call: CallbackQuery, state: FSMContext):
     if call.data == "sx:none":
         sel = []
         await draft_set(state, {"sfx_list": sel, "sfx_other": "", "sfx_none": True})
-        try:
-            await call.message.edit_reply_markup(reply_markup=kb_sfx_multi(sel, none_selected=True))
-        except TelegramBadRequest as e:
-            if "message is not modified" not in str(e):
-                raise
+        await edit_markup_if_changed(call, ("sx", tuple(sel), True), kb_sfx_multi(sel, none_selected=True))
         await call.answer()
         return
 
     if call.data == "sx:done":
-        await draft_set(state, {"sfx_list": sel})
         if not sel:
             await draft_set(state, {"sfx_list": [], "sfx_other": ""})
             await state.set_state(Survey.operator)
@@ -1233,20 +1326,21 @@ async def sfx_cb(call: CallbackQuery, state: FSMContext):
             return
 
         if "Другое" in sel:
+            await draft_set(state, {"sfx_list": sel})
             await state.set_state(Survey.sfx_other)
             await call.message.answer("Введите свой вариант спецэффектов:", reply_markup=kb_survey_reply())
             await call.answer()
             return
 
-        await draft_set(state, {"sfx_other": ""})
+        await draft_set(state, {"sfx_list": sel, "sfx_other": ""})
         await state.set_state(Survey.operator)
         await call.message.answer("18) Кто ведет мероприятие?", reply_markup=kb_inline("operator", 1))
         await call.answer()
         return
 
-    m = re.match(r"^sx:opt:(\d+)$", call.data)
-    if m:
-        idx = int(m.group(1))
+    idx_s = call.data[len("sx:opt:"):] if call.data.startswith("sx:opt:") else ""
+    if idx_s.isdecimal():
+        idx = int(idx_s)
         if 0 <= idx < len(opts):
             val = opts[idx]
             if val != "Нет":
@@ -1255,11 +1349,7 @@ async def sfx_cb(call: CallbackQuery, state: FSMContext):
                 else:
                     sel.append(val)
         await draft_set(state, {"sfx_list": sel, "sfx_none": False})
-        try:
-            await call.message.edit_reply_markup(reply_markup=kb_sfx_multi(sel, none_selected=False))
-        except TelegramBadRequest as e:
-            if "message is not modified" not in str(e):
-                raise
+        await edit_markup_if_changed(call, ("sx", tuple(sel), False), kb_sfx_multi(sel, none_selected=False))
         await call.answer()
         return
 
@@ -1269,18 +1359,19 @@ async def sfx_cb(call: CallbackQuery, state: FSMContext):
 @router.callback_query(F.data.startswith("ans:"))
 async def s_inline(call: CallbackQuery, state: FSMContext):
     _, field, idx_s = call.data.split(":", 2)
-    st = await state.get_state()
-    d = await draft_get(state)
-
-    if field not in SURVEY_OPTIONS:
+    opts = SURVEY_OPTIONS.get(field)
+    if opts is None:
         return await call.answer()
 
     try:
         idx = int(idx_s)
-        value = SURVEY_OPTIONS[field][idx]
+        value = opts[idx]
     except Exception:
         return await call.answer()
 
+    # черновик читается только в ветках, которым он нужен
+    st = await state.get_state()
+
     if field == "scene" and st == Survey.scene.state:
         await draft_set(state, {"scene": value})
         await state.set_state(Survey.night_mount)
@@ -1300,12 +1391,14 @@ async def s_inline(call: CallbackQuery, state: FSMContext):
         return await call.answer()
 
     if field == "extra_equipment" and st == Survey.extra_equipment.state:
-        await draft_set(state, {"extra_equipment": value})
+        patch = {"extra_equipment": value}
+        if value == "Нет":
+            patch["plugs"] = "—"
+        d = await draft_set(state, patch)
         if value == "Нет":
-            await draft_set(state, {"plugs": "—"})
             await state.set_state(Survey.power_type)
-            sel = (await draft_get(state)).get("power_types") or []
-            none_selected = bool((await draft_get(state)).get("power_none"))
+            sel = d.get("power_types") or []
+            none_selected = bool(d.get("power_none"))
             await call.message.answer(
                 "12) Выберите один или несколько вариантов и нажмите «➡️ Далее»:",
                 reply_markup=kb_power_types_multi(sel, none_selected=none_selected),
@@ -1316,6 +1409,7 @@ async def s_inline(call: CallbackQuery, state: FSMContext):
         return await call.answer()
 
     if field == "power_where" and st in {Survey.power_where.state, EditPower.power_where.state}:
+        d = await draft_get(state)
         items = d.get("power_items") or []
         i = int(d.get("power_i") or 0)
 
@@ -1365,12 +1459,14 @@ async def s_inline(call: CallbackQuery, state: FSMContext):
         return await call.answer()
 
     if field == "dimmer_needed" and st == Survey.dimmer_needed.state:
-        await draft_set(state, {"dimmer_needed": value})
+        patch = {"dimmer_needed": value}
+        if value == "Нет":
+            patch["dimmer_text"] = "—"
+        d = await draft_set(state, patch)
         if value == "Нет":
-            await draft_set(state, {"dimmer_text": "—"})
             await state.set_state(Survey.sfx)
-            sel = (await draft_get(state)).get("sfx_list") or []
-            none_selected = bool((await draft_get(state)).get("sfx_none"))
+            sel = d.get("sfx_list") or []
+            none_selected = bool(d.get("sfx_none"))
             await call.message.answer(
                 "17) Выберите один или несколько вариантов и нажмите «➡️ Далее»:",
                 reply_markup=kb_sfx_multi(sel, none_selected=none_selected),
@@ -1381,15 +1477,16 @@ async def s_inline(call: CallbackQuery, state: FSMContext):
         return await call.answer()
 
     if field == "operator" and st == Survey.operator.state:
-        await draft_set(state, {"operator": value})
+        patch = {"operator": value}
+        if value.startswith("Оператор"):
+            patch.update(console_help="—", console_model="—")
+        d = await draft_set(state, patch)
         if value.startswith("Оператор"):
-            await draft_set(state, {"console_help": "—", "console_model": "—"})
             await state.set_state(Survey.phone)
             await call.message.answer("21) Номер телефона для связи?", reply_markup=kb_survey_reply())
         else:
             await state.set_state(Survey.console_help)
-            d2 = await draft_get(state)
-            console_name = "GrandMa2 Light" if d2.get("scene") == "Большой зал" else "Chamsys MQ500"
+            console_name = venue_console(d.get("scene"))
             await call.message.answer(
                 f"19) Мы используем пульт {console_name}. Нужна помощь с пультом?",
                 reply_markup=kb_inline("console_help", 1),
@@ -1397,12 +1494,14 @@ async def s_inline(call: CallbackQuery, state: FSMContext):
         return await call.answer()
 
     if field == "console_help" and st == Survey.console_help.state:
-        await draft_set(state, {"console_help": value})
+        patch = {"console_help": value}
+        if value != "Привезем свой пульт":
+            patch["console_model"] = "—"
+        await draft_set(state, patch)
         if value == "Привезем свой пульт":
             await state.set_state(Survey.console_model)
             await call.message.answer("20) Марка и модель вашего пульта? (текст)", reply_markup=kb_survey_reply())
         else:
-            await draft_set(state, {"console_model": "—"})
             await state.set_state(Survey.phone)
             await call.message.answer("21) Номер телефона для связи?", reply_markup=kb_survey_reply())
         return await call.answer()
@@ -1411,52 +1510,39 @@ async def s_inline(call: CallbackQuery, state: FSMContext):
         if st == EditPower.confirm.state:
             if value.startswith("🔁"):
                 await state.clear()
-                await call.message.answer("Меню:", reply_markup=kb_menu(call.from_user.id))
+                await call.message.answer("Меню:", reply_markup=await kb_menu(call.from_user.id))
                 return await call.answer()
 
             d2 = await draft_get(state)
-            power_items = d2.get("power_items") or []
-            power_types = d2.get("power_types") or []
-
-            if not power_items and power_types:
-                power_items = [{"type": t, "count": 0, "where": []} for t in power_types]
-
-            if not power_items:
-                power_type = "Нет"
-                power_where_list = []
-                power_count_sum = 0
-            else:
-                power_type = ", ".join([x.get("type") for x in power_items if x.get("type")])
-                power_where_list = []
-                power_count_sum = 0
-                for it in power_items:
-                    power_count_sum += int(it.get("count") or 0)
-                    t = it.get("type")
-                    for w in (it.get("where") or []):
-                        power_where_list.append(f"{t}: {w}")
-
-            power_where_json = json.dumps(power_where_list, ensure_ascii=False)
+            power_type, power_where_list, power_count_sum = _finalize_power(
+                d2.get("power_items") or [], d2.get("power_types") or []
+            )
+            power_where_json = json_dumps(power_where_list)
 
             data = await state.get_data()
             sub_id = data.get("edit_sub_id")
             if not sub_id:
                 await state.clear()
-                await call.message.answer("Меню:", reply_markup=kb_menu(call.from_user.id))
+                await call.message.answer("Меню:", reply_markup=await kb_menu(call.from_user.id))
                 return await call.answer()
 
-            db.update_submission(
+            await adb(
+                db.update_submission,
                 int(sub_id),
                 {"power_type": power_type, "power_count": str(power_count_sum), "power_where_json": power_where_json},
             )
+            _MY_ANSWERS_CACHE.pop(call.from_user.id, None)
+            _FORM_TEXT_CACHE.pop(int(sub_id), None)
+            forget_month_forms()
 
             await state.clear()
-            await call.message.answer("✅ Силовые обновлены", reply_markup=kb_menu(call.from_user.id))
+            await call.message.answer("✅ Силовые обновлены", reply_markup=await kb_menu(call.from_user.id))
             return await call.answer()
 
         if value.startswith("🔁"):
-            db.delete_draft(call.from_user.id)
+            await adb(db.delete_draft, call.from_user.id)
             await state.clear()
-            await call.message.answer("Меню:", reply_markup=kb_menu(call.from_user.id))
+            await call.message.answer("Меню:", reply_markup=await kb_menu(call.from_user.id))
             return await call.answer()
 
         d2 = await draft_get(state)
@@ -1470,77 +1556,39 @@ async def s_inline(call: CallbackQuery, state: FSMContext):
         d2.setdefault("sfx_other", "")
         d2.setdefault("phone", "")
 
-        power_items = d2.get("power_items") or []
-        power_types = d2.get("power_types") or []
-        if not power_items and power_types:
-            power_items = [{"type": t, "count": 0, "where": []} for t in power_types]
-
-        if not power_items:
-            d2["power_type"] = "Нет"
-            power_where_list = []
-            power_count_sum = 0
-        else:
-            d2["power_type"] = ", ".join([x.get("type") for x in power_items if x.get("type")])
-            power_where_list = []
-            power_count_sum = 0
-            for it in power_items:
-                power_count_sum += int(it.get("count") or 0)
-                for w in (it.get("where") or []):
-                    power_where_list.append(f"{it.get('type')}: {w}")
+        d2["power_type"], power_where_list, power_count_sum = _finalize_power(
+            d2.get("power_items") or [], d2.get("power_types") or []
+        )
 
         sfx_list = d2.get("sfx_list") or []
-        d2["sfx_json"] = json.dumps(sfx_list, ensure_ascii=False)
+        d2["sfx_json"] = json_dumps(sfx_list)
         d2["sfx_other"] = str(d2.get("sfx_other") or "").strip()
 
         folder = folder_for(d2["event_date"], d2["org"], d2["event_title"])
-        await yd.ensure_folder(f"{YANDEX_ROOT}")
-        await yd.ensure_folder(folder)
 
         payload = dict(d2)
         payload["power_count"] = str(power_count_sum)
-        payload["power_where_json"] = json.dumps(power_where_list, ensure_ascii=False)
+        payload["power_where_json"] = json_dumps(power_where_list)
         payload["ydisk_folder"] = folder
-        payload["sfx_json"] = d2["sfx_json"]
-        payload["sfx_other"] = d2["sfx_other"]
-
-        sub_id = db.insert_submission(call.from_user.id, payload)
-        db.upsert_user_last(call.from_user.id, sub_id, folder)
-        db.delete_draft(call.from_user.id)
-
-        # === АВТОГЕНЕРАЦИЯ WORD + ЗАГРУЗКА В ПАПКУ АНКЕТЫ ===
-        try:
-            sub_for_doc = dict(payload)
-            sub_for_doc["id"] = sub_id
-            sub_for_doc["user_id"] = call.from_user.id
-            sub_for_doc["ydisk_folder"] = folder
-
-            # нормализуем console_model как в админ-выгрузке
-            if sub_for_doc.get("operator") != "Оператор Мастерской «12»":
-                if sub_for_doc.get("console_help") == "Привезем свой пульт":
-                    sub_for_doc["console_model"] = sub_for_doc.get("console_model") or "—"
-                else:
-                    sub_for_doc["console_model"] = (
-                        "GrandMa2 Light" if sub_for_doc.get("scene") == "Большой зал" else "Chamsys MQ500"
-                    )
-            else:
-                sub_for_doc["console_model"] = "—"
-
-            docx_data = build_docx_for_submission(sub_for_doc)
-            docx_name = (
-                f"анкета_{sub_id}_"
-                f"{sanitize_name(sub_for_doc['event_date'])}_"
-                f"{sanitize_name(sub_for_doc['org'])}_"
-                f"{sanitize_name(sub_for_doc['event_title'])}.docx"
-            )
-            await put_to_yandex(call.from_user.id, docx_name, docx_data)
-        except Exception:
-            # не валим сохранение анкеты из-за docx
-            pass
-        # === /АВТОГЕНЕРАЦИЯ WORD ===
+
+        # запись в БД и создание папки на Я.Диске независимы — идут параллельно
+        sub_id, folder_err = await asyncio.gather(
+            adb(db.commit_submission, call.from_user.id, payload),
+            ensure_folder_chain(f"{YANDEX_ROOT}", folder),
+            return_exceptions=True,
+        )
+        if isinstance(sub_id, BaseException):
+            raise sub_id
+        forget_month_forms()
+        if isinstance(folder_err, BaseException):
+            log.error("Submission #%s: cannot create folder %s: %r", sub_id, folder, folder_err)
+        _MY_ANSWERS_CACHE.pop(call.from_user.id, None)
+
+        # Word генерируется и грузится в фоне — очередь чата не ждет Я.Диск
+        spawn(upload_submission_docx(call.from_user.id, sub_id, payload, folder))
 
         await state.clear()
-        await call.message.answer(THANKS, reply_markup=kb_menu(call.from_user.id))
-        await call.message.answer("✅ Анкета сохранена", reply_markup=kb_menu(call.from_user.id))
+        await call.message.answer(f"✅ Анкета сохранена\n\n{THANKS}", reply_markup=await kb_menu(call.from_user.id))
         return await call.answer()
 
     await call.answer()
@@ -1583,7 +1631,12 @@ def month_shift(year: int, month: int, delta: int) -> Tuple[int, int]:
 
 def kb_months() -> ReplyKeyboardMarkup:
     now = datetime.now()
-    y0, m0 = now.year, now.month
+    return _kb_months_cached(now.year, now.month)
+
+
+# клавиатура зависит только от текущего месяца
+@lru_cache(maxsize=4)
+def _kb_months_cached(y0: int, m0: int) -> ReplyKeyboardMarkup:
     y_prev, m_prev = month_shift(y0, m0, -1)
     y_next, m_next = month_shift(y0, m0, +1)
 
@@ -1605,7 +1658,7 @@ def kb_months() -> ReplyKeyboardMarkup:
 
 def parse_month_btn(s: str) -> Optional[Tuple[int, int]]:
     s = (s or "").strip()
-    m = re.search(r"(\d{4})-(\d{2})", s)
+    m = MONTH_BTN_RE.search(s)
     if not m:
         return None
     y = int(m.group(1))
@@ -1624,131 +1677,138 @@ def kb_forms_list(rows: List[Any]) -> ReplyKeyboardMarkup:
     return ReplyKeyboardMarkup(keyboard=kb_rows, resize_keyboard=True)
 
 
-@router.message(F.text == "📄 Word анкеты")
+# (год, месяц) -> (когда загружено, строки, клавиатура kb_forms_list)
+_MONTH_CACHE: "OrderedDict[Tuple[int, int], Tuple[float, List[Any], ReplyKeyboardMarkup]]" = OrderedDict()
+_MONTH_CACHE_MAX = 24
+MONTH_CACHE_TTL = 60.0
+# растет при каждой записи в submissions: результат запроса, начатого до записи, не кэшируем
+_month_gen = 0
+
+
+def forget_month_forms() -> None:
+    global _month_gen
+    _month_gen += 1
+    _MONTH_CACHE.clear()
+
+
+async def month_forms(year: int, month: int) -> Tuple[List[Any], ReplyKeyboardMarkup]:
+    """Submissions of a month with their picker keyboard, cached for MONTH_CACHE_TTL seconds."""
+    key = (year, month)
+    hit = _MONTH_CACHE.get(key)
+    now = time.monotonic()
+    if hit is not None and now - hit[0] < MONTH_CACHE_TTL:
+        return hit[1], hit[2]
+    gen = _month_gen
+    rows = await adb(db.list_submissions_by_month, year, month, limit=200)
+    kb = kb_forms_list(rows)
+    if gen == _month_gen:
+        _MONTH_CACHE[key] = (now, rows, kb)
+        _MONTH_CACHE.move_to_end(key)
+        if len(_MONTH_CACHE) > _MONTH_CACHE_MAX:
+            _MONTH_CACHE.popitem(last=False)
+    return rows, kb
+
+
+@admin_router.message(F.text == "📄 Word анкеты")
 async def a_word_start(message: Message, state: FSMContext):
-    if not is_admin(message.from_user.id):
-        return
     await state.clear()
     await state.set_state(AdminWord.pick_month)
     await message.answer("Выберите месяц:", reply_markup=kb_months())
 
 
-@router.message(AdminWord.pick_month)
-async def a_word_pick_month(message: Message, state: FSMContext):
-    if not is_admin(message.from_user.id):
-        return
-    if message.text == "⬅️ Назад":
-        await state.clear()
-        await message.answer("Админ-меню:", reply_markup=kb_admin_menu())
-        return
+def make_pick_month(next_state: State, prompt: str) -> Callable[[Message, FSMContext], Awaitable[None]]:
+    """Month picker handler shared by the admin flows; differs only in the next state and prompt."""
 
-    ym = parse_month_btn(message.text or "")
-    if not ym:
-        await message.answer("Выберите месяц кнопкой.", reply_markup=kb_months())
-        return
+    async def pick_month(message: Message, state: FSMContext) -> None:
+        if message.text == "⬅️ Назад":
+            await state.clear()
+            await message.answer("Админ-меню:", reply_markup=kb_admin_menu())
+            return
 
-    year, month = ym
-    rows = db.list_submissions_by_month(year, month, limit=200)
-    if not rows:
-        await message.answer("Анкет за этот месяц нет.", reply_markup=kb_months())
-        return
+        ym = parse_month_btn(message.text or "")
+        if not ym:
+            await message.answer("Выберите месяц кнопкой.", reply_markup=kb_months())
+            return
 
-    await state.set_state(AdminWord.pick_form)
-    await message.answer("Выберите анкету:", reply_markup=kb_forms_list(rows))
+        year, month = ym
+        rows, forms_kb = await month_forms(year, month)
+        if not rows:
+            await message.answer("Анкет за этот месяц нет.", reply_markup=kb_months())
+            return
 
+        await state.set_state(next_state)
+        await message.answer(prompt, reply_markup=forms_kb)
 
-@router.message(AdminWord.pick_form)
-async def a_word_pick_form(message: Message, state: FSMContext):
-    if not is_admin(message.from_user.id):
-        return
+    return pick_month
+
+
+async def pick_form_submission(message: Message, state: FSMContext, back_state: State) -> Optional[Any]:
+    """Common pick_form prologue: «Назад», #id parsing and lookup. None means the reply is already sent."""
     if message.text == "⬅️ Назад":
-        await state.set_state(AdminWord.pick_month)
+        await state.set_state(back_state)
         await message.answer("Выберите месяц:", reply_markup=kb_months())
-        return
+        return None
 
-    m = re.match(r"^#(\d+)", (message.text or "").strip())
+    m = SUB_ID_RE.match((message.text or "").strip())
     if not m:
         await message.answer("Выберите анкету кнопкой.")
-        return
+        return None
 
-    sub_id = int(m.group(1))
-    sub_row = db.get_submission(sub_id)
-    if not sub_row:
+    sub = await adb(db.get_submission, int(m.group(1)))
+    if not sub:
         await message.answer("Не найдено.")
+        return None
+    return sub
+
+
+a_word_pick_month = admin_router.message(AdminWord.pick_month)(
+    make_pick_month(AdminWord.pick_form, "Выберите анкету:")
+)
+
+
+@admin_router.message(AdminWord.pick_form)
+async def a_word_pick_form(message: Message, state: FSMContext):
+    sub_row = await pick_form_submission(message, state, AdminWord.pick_month)
+    if sub_row is None:
         return
+    sub_id = int(sub_row["id"])
 
     sub = dict(sub_row)
 
-    if sub.get("operator") != "Оператор Мастерской «12»":
-        if sub.get("console_help") == "Привезем свой пульт":
-            sub["console_model"] = sub.get("console_model") or "—"
-        else:
-            sub["console_model"] = "GrandMa2 Light" if sub.get("scene") == "Большой зал" else "Chamsys MQ500"
-    else:
-        sub["console_model"] = "—"
+    sub["console_model"] = resolve_console_model(sub)
 
-    data = build_docx_for_submission(sub)
+    # docx пишется на диск в отдельном процессе, aiogram отправляет файл по кускам
+    tmp_path = await run_docx(build_docx_tempfile, sub)
     filename = f"анкета_{sub_id}_{sanitize_name(sub['event_date'])}_{sanitize_name(sub['org'])}_{sanitize_name(sub['event_title'])}.docx"
-    await message.answer_document(
-        BufferedInputFile(data, filename=filename),
-        caption=f"Анкета #{sub_id}",
-        reply_markup=kb_admin_menu(),
-    )
+    try:
+        await message.answer_document(
+            FSInputFile(tmp_path, filename=filename),
+            caption=f"Анкета #{sub_id}",
+            reply_markup=kb_admin_menu(),
+        )
+    finally:
+        os.unlink(tmp_path)
     await state.clear()
 
 
-@router.message(F.text == "🗑 Удалить анкету")
+@admin_router.message(F.text == "🗑 Удалить анкету")
 async def a_del_start(message: Message, state: FSMContext):
-    if not is_admin(message.from_user.id):
-        return
     await state.clear()
     await state.set_state(AdminDel.pick_month)
     await message.answer("Выберите месяц для удаления:", reply_markup=kb_months())
 
 
-@router.message(AdminDel.pick_month)
-async def a_del_pick_month(message: Message, state: FSMContext):
-    if not is_admin(message.from_user.id):
-        return
-    if message.text == "⬅️ Назад":
-        await state.clear()
-        await message.answer("Админ-меню:", reply_markup=kb_admin_menu())
-        return
-
-    ym = parse_month_btn(message.text or "")
-    if not ym:
-        await message.answer("Выберите месяц кнопкой.", reply_markup=kb_months())
-        return
-
-    year, month = ym
-    rows = db.list_submissions_by_month(year, month, limit=200)
-    if not rows:
-        await message.answer("Анкет за этот месяц нет.", reply_markup=kb_months())
-        return
-
-    await state.set_state(AdminDel.pick_form)
-    await message.answer("Выберите анкету для удаления:", reply_markup=kb_forms_list(rows))
+a_del_pick_month = admin_router.message(AdminDel.pick_month)(
+    make_pick_month(AdminDel.pick_form, "Выберите анкету для удаления:")
+)
 
 
-@router.message(AdminDel.pick_form)
+@admin_router.message(AdminDel.pick_form)
 async def a_del_pick_form(message: Message, state: FSMContext):
-    if not is_admin(message.from_user.id):
-        return
-    if message.text == "⬅️ Назад":
-        await state.set_state(AdminDel.pick_month)
-        await message.answer("Выберите месяц:", reply_markup=kb_months())
-        return
-
-    m = re.match(r"^#(\d+)", (message.text or "").strip())
-    if not m:
-        await message.answer("Выберите анкету кнопкой.")
-        return
-
-    sub_id = int(m.group(1))
-    sub = db.get_submission(sub_id)
-    if not sub:
-        await message.answer("Не найдено.")
+    sub = await pick_form_submission(message, state, AdminDel.pick_month)
+    if sub is None:
         return
+    sub_id = int(sub["id"])
 
     await state.update_data(del_sub_id=sub_id)
     await state.set_state(AdminDel.confirm)
@@ -1765,11 +1825,18 @@ async def a_del_pick_form(message: Message, state: FSMContext):
     )
 
 
-@router.message(AdminDel.confirm)
-async def a_del_confirm(message: Message, state: FSMContext):
-    if not is_admin(message.from_user.id):
+async def drop_submission_folder(folder: Optional[str]) -> None:
+    if not folder:
         return
+    try:
+        await yd.delete(folder, permanently=False)
+    except Exception:
+        pass
+    forget_folder(folder)
 
+
+@admin_router.message(AdminDel.confirm)
+async def a_del_confirm(message: Message, state: FSMContext):
     if message.text == "⬅️ Назад":
         await state.set_state(AdminDel.pick_month)
         await message.answer("Выберите месяц:", reply_markup=kb_months())
@@ -1786,89 +1853,59 @@ async def a_del_confirm(message: Message, state: FSMContext):
         await message.answer("Админ-меню:", reply_markup=kb_admin_menu())
         return
 
-    sub = db.get_submission(sub_id)
+    sub = await adb(db.get_submission, sub_id)
     folder = sub["ydisk_folder"] if sub else None
 
-    if folder:
-        try:
-            await yd.delete(folder, permanently=False)
-        except Exception:
-            pass
-
-    ok = db.delete_submission(sub_id)
+    # удаление на Я.Диске и в БД независимы — выполняем одновременно
+    ok, _ = await asyncio.gather(adb(db.delete_submission, sub_id), drop_submission_folder(folder))
+    _FORM_TEXT_CACHE.pop(sub_id, None)
+    forget_month_forms()
 
     await state.clear()
     await message.answer("✅ удалено" if ok else "не найдено", reply_markup=kb_admin_menu())
 
 
-@router.message(F.text == "📊 Статистика")
+@admin_router.message(F.text == "📊 Статистика")
 async def a_stats(message: Message):
-    if not is_admin(message.from_user.id):
-        return
-    await message.answer(f"Всего анкет: {db.count_submissions()}", reply_markup=kb_admin_menu())
+    await message.answer(f"Всего анкет: {await adb(db.count_submissions)}", reply_markup=kb_admin_menu())
 
 
-@router.message(F.text == "📋 Анкеты")
+@admin_router.message(F.text == "📋 Анкеты")
 async def a_forms_start(message: Message, state: FSMContext):
-    if not is_admin(message.from_user.id):
-        return
     await state.clear()
     await state.set_state(AdminForms.pick_month)
     await message.answer("Выберите месяц:", reply_markup=kb_months())
 
 
-@router.message(AdminForms.pick_month)
-async def a_forms_pick_month(message: Message, state: FSMContext):
-    if not is_admin(message.from_user.id):
-        return
-
-    if message.text == "⬅️ Назад":
-        await state.clear()
-        await message.answer("Админ-меню:", reply_markup=kb_admin_menu())
-        return
-
-    ym = parse_month_btn(message.text or "")
-    if not ym:
-        await message.answer("Выберите месяц кнопкой.", reply_markup=kb_months())
-        return
-
-    year, month = ym
-    rows = db.list_submissions_by_month(year, month, limit=200)
-    if not rows:
-        await message.answer("Анкет за этот месяц нет.", reply_markup=kb_months())
-        return
-
-    await state.set_state(AdminForms.pick_form)
-    await message.answer("Выберите анкету:", reply_markup=kb_forms_list(rows))
+a_forms_pick_month = admin_router.message(AdminForms.pick_month)(
+    make_pick_month(AdminForms.pick_form, "Выберите анкету:")
+)
 
 
-@router.message(AdminForms.pick_form)
+@admin_router.message(AdminForms.pick_form)
 async def a_forms_pick_form(message: Message, state: FSMContext):
-    if not is_admin(message.from_user.id):
+    sub = await pick_form_submission(message, state, AdminForms.pick_month)
+    if sub is None:
         return
 
-    if message.text == "⬅️ Назад":
-        await state.set_state(AdminForms.pick_month)
-        await message.answer("Выберите месяц:", reply_markup=kb_months())
-        return
+    # список файлов грузится, пока форматируем и отправляем анкету
+    files_task = asyncio.create_task(yd.list_files(sub["ydisk_folder"], limit=50))
 
-    m = re.match(r"^#(\d+)", (message.text or "").strip())
-    if not m:
-        await message.answer("Выберите анкету кнопкой.")
-        return
-
-    sub_id = int(m.group(1))
-    sub = db.get_submission(sub_id)
-    if not sub:
-        await message.answer("Не найдено.")
-        return
-
-    a = submission_to_dict(sub)
-    info = "📄 Анкета\n\n" + answers_text(a) + f"\n\n📂 {sub['ydisk_folder']}"
+    sub_id = int(sub["id"])
+    hit = _FORM_TEXT_CACHE.get(sub_id)
+    if hit is not None and hit[0] == sub["updated_at"]:
+        info = hit[1]
+        _FORM_TEXT_CACHE.move_to_end(sub_id)
+    else:
+        a = submission_to_dict(sub)
+        info = "📄 Анкета\n\n" + answers_text(a) + f"\n\n📂 {sub['ydisk_folder']}"
+        _FORM_TEXT_CACHE[sub_id] = (sub["updated_at"], info)
+        if len(_FORM_TEXT_CACHE) > _FORM_TEXT_CACHE_MAX:
+            _FORM_TEXT_CACHE.popitem(last=False)
     await message.answer(info, reply_markup=kb_admin_menu())
 
     try:
-        files = await yd.list_files(sub["ydisk_folder"], limit=50)
+        files = await files_task
     except Exception:
         files = []
 
@@ -1876,28 +1913,79 @@ async def a_forms_pick_form(message: Message, state: FSMContext):
         await message.answer("Файлов в папке нет.")
         return
 
-    kb_rows = []
-    for f in files:
-        token = os.urandom(6).hex()
-        SUB_DL_MAP[token] = f["path"]
-        kb_rows.append([InlineKeyboardButton(text=f"⬇️ {f['name']}", callback_data=f"dls:{token}")])
+    tokens = [secrets.token_urlsafe(6) for _ in files]
+    issued = time.monotonic()
+    SUB_DL_MAP.update(zip(tokens, ((issued, f["path"]) for f in files)))
+    kb_rows = [
+        [InlineKeyboardButton(text=f"⬇️ {f['name']}", callback_data=f"dls:{t}")] for t, f in zip(tokens, files)
+    ]
+    while len(SUB_DL_MAP) > SUB_DL_MAP_MAX:
+        SUB_DL_MAP.popitem(last=False)
 
     await message.answer("Документы анкеты — скачать:", reply_markup=InlineKeyboardMarkup(inline_keyboard=kb_rows))
 
 
-@router.message()
+@fallback_router.message()
 async def fallback(message: Message):
-    await message.answer("Меню:", reply_markup=kb_menu(message.from_user.id))
+    await message.answer("Меню:", reply_markup=await kb_menu(message.from_user.id))
+
+
+def make_fsm_storage() -> BaseStorage:
+    if not REDIS_URL:
+        return MemoryStorage()
+    # импорт здесь: пакет redis нужен только при REDIS_URL
+    try:
+        from aiogram.fsm.storage.redis import RedisStorage
+    except ImportError as e:
+        raise RuntimeError("REDIS_URL is set but the redis package is not installed (pip install redis)") from e
+
+    return RedisStorage.from_url(
+        REDIS_URL,
+        connection_kwargs={"max_connections": REDIS_MAX_CONNECTIONS},
+        state_ttl=FSM_TTL_SECONDS,
+        data_ttl=FSM_TTL_SECONDS,
+        json_loads=json_loads,
+        json_dumps=json_dumps,
+    )
 
 
 async def main():
+    global db, yd, DOCX_POOL
+    if not BOT_TOKEN:
+        raise RuntimeError("No BOT_TOKEN in .env")
+    if not ADMIN_IDS:
+        raise RuntimeError("No ADMIN_IDS in .env")
+    if not YANDEX_TOKEN:
+        raise RuntimeError("No YANDEX_TOKEN in .env")
+
+    db = DB(DB_PATH)
+    yd = YDisk(YANDEX_TOKEN)
+    # spawn, а не fork: не копируем процесс с живым event loop и потоками;
+    # воркер импортирует main.py как __mp_main__, но на уровне модуля побочных эффектов нет
+    DOCX_POOL = ProcessPoolExecutor(max_workers=DOCX_WORKERS, mp_context=multiprocessing.get_context("spawn"))
     bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+    bot.session.middleware(OutboundRateLimit(TG_RATE_PER_SEC))
+    # корень нужен раньше дочерних папок, LOCAL и INBOX — параллельно
     await yd.ensure_folder(f"{YANDEX_ROOT}")
-    await yd.ensure_folder(f"{YANDEX_ROOT}/{YANDEX_LOCAL}")
-    await yd.ensure_folder(f"{YANDEX_ROOT}/{YANDEX_INBOX}")
-    dp = Dispatcher()
-    dp.include_router(router)
-    await dp.start_polling(bot)
+    await asyncio.gather(
+        yd.ensure_folder(f"{YANDEX_ROOT}/{YANDEX_LOCAL}"),
+        yd.ensure_folder(f"{YANDEX_ROOT}/{YANDEX_INBOX}"),
+    )
+    dp = Dispatcher(storage=make_fsm_storage())
+    per_chat = PerChatConcurrency()
+    dp.message.outer_middleware(per_chat)
+    dp.callback_query.outer_middleware(per_chat)
+    # порядок важен: общие хендлеры, затем админские, затем fallback
+    dp.include_routers(router, admin_router, fallback_router)
+    sweeper = spawn(dl_sweeper())
+    try:
+        await dp.start_polling(bot)
+    finally:
+        sweeper.cancel()
+        # дожидаемся фоновых загрузок docx, пока пул и клиент Я.Диска еще открыты
+        await asyncio.gather(*_BACKGROUND, return_exceptions=True)
+        await asyncio.to_thread(DOCX_POOL.shutdown)
+        await yd.aclose()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,164 @@
+"""Рендер ответов анкеты: текст «Мои ответы» / админ-просмотр.
+
+Чистые функции без зависимостей от aiogram — модуль можно собрать mypyc (см. setup.py).
+"""
+from typing import Any, Dict, List
+
+from jsonutil import json_loads
+
+MASTER12_OPERATOR = "Оператор Мастерской «12»"
+OWN_CONSOLE = "Привезем свой пульт"
+# пульт площадки по сцене; на остальных сценах — DEFAULT_CONSOLE
+SCENE_CONSOLE: Dict[str, str] = {"Большой зал": "GrandMa2 Light"}
+DEFAULT_CONSOLE = "Chamsys MQ500"
+
+
+def venue_console(scene: Any) -> str:
+    return SCENE_CONSOLE.get(str(scene or "").strip(), DEFAULT_CONSOLE)
+
+
+def resolve_console_model(a: Dict[str, Any]) -> str:
+    """«—» при операторе Мастерской, иначе свой пульт группы или пульт площадки."""
+    if str(a.get("operator") or "").strip() == MASTER12_OPERATOR:
+        return "—"
+    if str(a.get("console_help") or "").strip() == OWN_CONSOLE:
+        return str(a.get("console_model") or "—").strip()
+    return venue_console(a.get("scene"))
+
+
+def _safe_row_get(row: Any, key: str, default: Any = None) -> Any:
+    try:
+        if hasattr(row, "keys") and key in row.keys():
+            return row[key]
+    except Exception:
+        pass
+    return default
+
+
+def submission_to_dict(row: Any) -> Dict[str, Any]:
+    power_where_list = json_loads(_safe_row_get(row, "power_where_json", "[]") or "[]")
+    sfx_json = _safe_row_get(row, "sfx_json", "[]") or "[]"
+    try:
+        sfx_list = json_loads(sfx_json)
+    except Exception:
+        sfx_list = []
+    if not isinstance(sfx_list, list):
+        sfx_list = []
+    sfx_other = _safe_row_get(row, "sfx_other", "") or ""
+    return {
+        "org": row["org"],
+        "role": row["role"],
+        "name": row["name"],
+        "phone": _safe_row_get(row, "phone", "") or "",
+        "event_date": row["event_date"],
+        "event_title": row["event_title"],
+        "scene": row["scene"],
+        "night_mount": row["night_mount"],
+        "mount_who": row["mount_who"],
+        "techs_count": row["techs_count"],
+        "extra_equipment": row["extra_equipment"],
+        "plugs": row["plugs"],
+        "power_type": (row["power_type"] or "Нет"),
+        "power_where_list": power_where_list,
+        "dimmer_needed": row["dimmer_needed"],
+        "dimmer_text": row["dimmer_text"],
+        "sfx_json": sfx_json,
+        "sfx_other": sfx_other,
+        "sfx_list": sfx_list,
+        "operator": row["operator"],
+        "console_help": row["console_help"],
+        "console_model": row["console_model"],
+        "ydisk_folder": row["ydisk_folder"],
+        "id": row["id"],
+        "user_id": row["user_id"],
+    }
+
+
+def answers_text(a: Dict[str, Any]) -> str:
+    def fmt_list(xs: List[str]) -> str:
+        if not xs:
+            return "—"
+        return "\n" + "\n".join([f"  - {x}" for x in xs])
+
+    def g(k: str) -> str:
+        v = a.get(k)
+        if v is None or v == "" or v == []:
+            return "—"
+        if isinstance(v, list):
+            return fmt_list([str(x) for x in v])
+        return str(v)
+
+    power_where = a.get("power_where_list") or []
+    power_type = str(a.get("power_type") or "").strip()
+    power_items = a.get("power_items") or []
+    power_types = a.get("power_types") or []
+
+    if (not power_where) and power_items:
+        power_where = [
+            f"{t}: {w}"
+            for it in power_items if it
+            for t in (it.get("type"),) if t
+            for w in (it.get("where") or [])
+        ]
+
+    if (not power_type) and power_items:
+        power_type = ", ".join(str(t) for it in power_items if it and (t := it.get("type")))
+
+    if (not power_type) and power_types:
+        power_type = ", ".join([str(x) for x in power_types if x])
+
+    power_needed = "Да"
+    if (not power_where) and (power_type in {"", "—", "Нет", "0"}):
+        power_needed = "Нет"
+    if str(power_type).strip() == "Нет":
+        power_needed = "Нет"
+    if power_needed == "Нет" and (power_types or power_items):
+        power_needed = "Да"
+
+    dimmer_needed = str(a.get("dimmer_needed") or "—").strip()
+
+    sfx_list = a.get("sfx_list")
+    if sfx_list is None:
+        try:
+            sfx_list = json_loads(a.get("sfx_json") or "[]")
+        except Exception:
+            sfx_list = []
+    if not isinstance(sfx_list, list):
+        sfx_list = []
+    sfx_other = str(a.get("sfx_other") or "").strip()
+    if sfx_other and ("Другое" in sfx_list):
+        sfx_list = [x if x != "Другое" else f"Другое: {sfx_other}" for x in sfx_list]
+    a["sfx_list"] = sfx_list
+
+    operator = str(a.get("operator") or "—").strip()
+    console_help = str(a.get("console_help") or "—").strip()
+    console_model = resolve_console_model(a)
+
+    lines = [
+        f"1) Организация: {g('org')}",
+        f"2) Должность: {g('role')}",
+        f"3) Имя: {g('name')}",
+        f"4) Телефон: {g('phone')}",
+        f"5) Дата: {g('event_date')}",
+        f"6) Название мероприятия: {g('event_title')}",
+        f"7) Сцена: {g('scene')}",
+        f"8) Ночной монтаж: {g('night_mount')}",
+        f"9) Монтаж: {g('mount_who')}",
+        f"10) Техников: {g('techs_count')}",
+        f"11) Доп. оборудование: {g('extra_equipment')}",
+        f"12) Вилки: {g('plugs')}",
+        f"13) Силовые: {power_needed}",
+        f"14) Где силовые: {fmt_list(power_where) if power_where else '—'}",
+        f"15) Диммер: {dimmer_needed}",
+    ]
+    if dimmer_needed == "Да":
+        lines.append(f"16) Диммер где и сколько: {g('dimmer_text')}")
+    lines.append(f"17) Спецэффекты: {g('sfx_list')}")
+    lines.extend(
+        [
+            f"18) Кто ведет: {operator}",
+            f"19) Помощь с пультом: {console_help}",
+            f"20) Пульт: {console_model}",
+        ]
+    )
+    return "\n".join(lines)
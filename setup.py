@@ -0,0 +1,15 @@
+"""Optional native build of render.py with mypyc.
+
+    pip install mypy
+    python setup.py build_ext --inplace
+
+The bot runs unchanged without it; the compiled render.*.so simply shadows render.py.
+"""
+from setuptools import setup
+from mypyc.build import mypycify
+
+setup(
+    name="m12-render",
+    py_modules=[],
+    ext_modules=mypycify(["render.py"]),
+)
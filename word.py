@@ -0,0 +1,104 @@
+"""Word-выгрузка анкеты (python-docx).
+
+Чистые функции без зависимостей от aiogram; main.py запускает их в DOCX-пуле процессов.
+"""
+import os
+import tempfile
+from io import BytesIO
+from typing import IO, Any
+
+from docx import Document
+from docx.shared import Pt
+
+from jsonutil import json_loads
+
+
+def build_docx_for_submission(sub: Any) -> bytes:
+    buf = BytesIO()
+    write_docx_for_submission(sub, buf)
+    return buf.getvalue()
+
+
+def build_docx_tempfile(sub: Any) -> str:
+    """Save the submission docx to a temp file and return its path; the caller unlinks it."""
+    with tempfile.NamedTemporaryFile(suffix=".docx", delete=False) as tmp:
+        try:
+            write_docx_for_submission(sub, tmp)
+        except BaseException:
+            tmp.close()
+            os.unlink(tmp.name)
+            raise
+    return tmp.name
+
+
+def write_docx_for_submission(sub: Any, out: IO[bytes]) -> None:
+    d = Document()
+    p = d.add_paragraph("Анкета участника фестиваля")
+    if p.runs:
+        p.runs[0].font.size = Pt(14)
+
+    d.add_paragraph(f"ID анкеты: {sub['id']}")
+    d.add_paragraph(f"Организация: {sub['org']}")
+    d.add_paragraph(f"Название мероприятия: {sub['event_title']}")
+    d.add_paragraph(f"Дата мероприятия: {sub['event_date']}")
+    d.add_paragraph(f"Сцена: {sub['scene']}")
+    d.add_paragraph("")
+
+    table = d.add_table(rows=1, cols=2)
+    hdr = table.rows[0].cells
+    hdr[0].text = "Вопрос"
+    hdr[1].text = "Ответ"
+
+    def add(q: str, a: str):
+        row = table.add_row().cells
+        row[0].text = q
+        row[1].text = a if (a and str(a).strip()) else "—"
+
+    add("1 Организация", sub["org"])
+    add("2 Должность", sub["role"])
+    add("3 Имя", sub["name"])
+    add("4 Телефон", sub.get("phone", "") or "—")
+    add("5 Дата проведения", sub["event_date"])
+    add("6 Название мероприятия", sub["event_title"])
+    add("7 Сцена", sub["scene"])
+    add("8 Ночной монтаж", sub["night_mount"])
+    add("9 Кто монтирует", sub["mount_who"])
+    add("10 Сколько техников", sub["techs_count"])
+    add("11 Доп. оборудование", sub["extra_equipment"])
+    add("12 Вилки", sub["plugs"])
+
+    power_where_list = json_loads(sub.get("power_where_json") or "[]")
+    power_type = str(sub.get("power_type") or "").strip()
+    power_needed = "Да"
+    if (not power_where_list) and (power_type in {"", "—", "Нет", "0"}):
+        power_needed = "Нет"
+    if power_type == "Нет":
+        power_needed = "Нет"
+    add("13 Силовые подключения", power_needed)
+    add("14 Где силовые", "\n".join(power_where_list) if power_where_list else "—")
+
+    add("15 Диммер", sub["dimmer_needed"])
+    if str(sub["dimmer_needed"]).strip() == "Да":
+        add("16 Диммер где и сколько", sub["dimmer_text"])
+
+    try:
+        sfx_list = json_loads(sub.get("sfx_json") or "[]")
+    except Exception:
+        sfx_list = []
+    if not isinstance(sfx_list, list):
+        sfx_list = []
+    sfx_other = str(sub.get("sfx_other") or "").strip()
+    if sfx_other and ("Другое" in sfx_list):
+        sfx_list = [x if x != "Другое" else f"Другое: {sfx_other}" for x in sfx_list]
+    add("17 Спецэффекты", "\n".join(sfx_list) if sfx_list else "Нет")
+
+    add("18 Кто ведет", sub["operator"])
+    add("19 Помощь с пультом", sub["console_help"])
+    add("20 Пульт", sub["console_model"])
+    add("Папка на Я.Диске", sub["ydisk_folder"])
+
+    d.add_paragraph("")
+    d.add_paragraph("Подпись: ______________________")
+    d.add_paragraph("Расшифровка: __________________")
+
+    d.save(out)
@@ -1,16 +1,29 @@
-import re
-from dataclasses import dataclass
-from typing import Optional
+import asyncio
+import importlib.util
+import time
+from functools import lru_cache
+from typing import AsyncIterator, Dict, List, Optional, Tuple, Union
 
 import httpx
 
+# orjson, если установлен: разбирает bytes ответа без декодирования в str
+from jsonutil import json_loads
+from keylocks import KeyedLocks
+
 API = "https://cloud-api.yandex.net/v1/disk"
+# запрещенные в именах файлов символы -> "_"
+FS_BAD_TABLE = str.maketrans(dict.fromkeys('\\/:*?"<>|', "_"))
+UPLOAD_CHUNK = 1 << 20
+# HTTP/2 включаем, только если установлен h2 (httpx[http2])
+HTTP2 = importlib.util.find_spec("h2") is not None
+# сколько секунд держим список файлов папки без повторного запроса
+LIST_TTL = 30.0
 
 
+@lru_cache(maxsize=4096)
 def sanitize_name(s: str) -> str:
-    s = (s or "").strip()
-    s = re.sub(r"[\\/:\*\?\"<>\|]", "_", s)
-    s = re.sub(r"\s+", " ", s)
+    # split/join схлопывает серии пробельных символов в один пробел
+    s = " ".join((s or "").strip().translate(FS_BAD_TABLE).split())
     return (s[:120] if s else "Без_названия").strip()
 
 
@@ -22,64 +35,126 @@ def month_prefix_from_ddmmyyyy(date_str: str) -> str:
         return "00"
 
 
-@dataclass
+async def _iter_view(mv: memoryview) -> AsyncIterator[bytes]:
+    # httpx принимает только bytes: каждый кусок копируется, но не больше UPLOAD_CHUNK за раз
+    for i in range(0, mv.nbytes, UPLOAD_CHUNK):
+        yield bytes(mv[i:i + UPLOAD_CHUNK])
+
+
 class YDisk:
-    token: str
+    """Yandex.Disk REST client with one shared keep-alive connection pool."""
+
+    def __init__(self, token: str):
+        self.token = token
+        self._client: Optional[httpx.AsyncClient] = None
+        self._client_lock = asyncio.Lock()
+        # path -> (когда получено, limit, файлы); сбрасывается при upload/delete в папке
+        self._list_cache: Dict[str, Tuple[float, int, List[dict]]] = {}
+        self._list_locks = KeyedLocks()
+        self._list_gen = 0
 
     def _headers(self) -> dict:
         return {"Authorization": f"OAuth {self.token}"}
 
-    async def ensure_folder(self, path: str) -> None:
-        async with httpx.AsyncClient(timeout=60) as client:
-            r = await client.put(f"{API}/resources", headers=self._headers(), params={"path": path})
-            if r.status_code in (201, 409):
-                return
-            r.raise_for_status()
+    async def _client_ready(self) -> httpx.AsyncClient:
+        if self._client is None:
+            async with self._client_lock:
+                if self._client is None:
+                    self._client = httpx.AsyncClient(
+                        http2=HTTP2,
+                        timeout=httpx.Timeout(60.0, connect=10.0),
+                        limits=httpx.Limits(max_keepalive_connections=20, max_connections=50),
+                    )
+        return self._client
+
+    def _forget_listing(self, path: str) -> None:
+        """Drop cached listings of path and of its parent folder."""
+        self._list_gen += 1
+        self._list_cache.pop(path, None)
+        self._list_cache.pop(path.rstrip("/").rsplit("/", 1)[0], None)
+
+    async def aclose(self) -> None:
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
 
-    async def upload_bytes(self, disk_path: str, data: bytes, overwrite: bool = True) -> None:
-        async with httpx.AsyncClient(timeout=120) as client:
-            r = await client.get(
-                f"{API}/resources/upload",
-                headers=self._headers(),
-                params={"path": disk_path, "overwrite": str(overwrite).lower()},
+    async def ensure_folder(self, path: str) -> None:
+        client = await self._client_ready()
+        r = await client.put(f"{API}/resources", headers=self._headers(), params={"path": path})
+        if r.status_code in (201, 409):
+            return
+        r.raise_for_status()
+
+    async def upload_bytes(
+        self, disk_path: str, data: Union[bytes, bytearray, memoryview], overwrite: bool = True
+    ) -> None:
+        """Upload a bytes-like buffer; bytearray/memoryview are streamed in UPLOAD_CHUNK pieces."""
+        client = await self._client_ready()
+        r = await client.get(
+            f"{API}/resources/upload",
+            headers=self._headers(),
+            params={"path": disk_path, "overwrite": str(overwrite).lower()},
+        )
+        r.raise_for_status()
+        href = json_loads(r.content)["href"]
+        if isinstance(data, bytes):
+            up = await client.put(href, content=data, timeout=120)
+        else:
+            mv = memoryview(data).cast("B")
+            up = await client.put(
+                href, content=_iter_view(mv), headers={"Content-Length": str(mv.nbytes)}, timeout=120
             )
-            r.raise_for_status()
-            href = r.json()["href"]
-            up = await client.put(href, content=data)
-            up.raise_for_status()
+        up.raise_for_status()
+        self._forget_listing(disk_path)
 
     async def delete(self, path: str, permanently: bool = False) -> None:
-        async with httpx.AsyncClient(timeout=60) as client:
-            r = await client.delete(
-                f"{API}/resources",
-                headers=self._headers(),
-                params={"path": path, "permanently": str(permanently).lower()},
-            )
-            if r.status_code in (202, 204, 404):
-                return
+        client = await self._client_ready()
+        r = await client.delete(
+            f"{API}/resources",
+            headers=self._headers(),
+            params={"path": path, "permanently": str(permanently).lower()},
+        )
+        if r.status_code not in (202, 204, 404):
             r.raise_for_status()
+        self._forget_listing(path)
 
     async def publish(self, path: str) -> Optional[str]:
-        async with httpx.AsyncClient(timeout=60) as client:
-            r = await client.put(f"{API}/resources/publish", headers=self._headers(), params={"path": path})
-            if r.status_code not in (200, 201, 409):
-                r.raise_for_status()
-            meta = await client.get(f"{API}/resources", headers=self._headers(), params={"path": path})
-            meta.raise_for_status()
-            return meta.json().get("public_url")
+        client = await self._client_ready()
+        r = await client.put(f"{API}/resources/publish", headers=self._headers(), params={"path": path})
+        if r.status_code not in (200, 201, 409):
+            r.raise_for_status()
+        meta = await client.get(f"{API}/resources", headers=self._headers(), params={"path": path})
+        meta.raise_for_status()
+        return json_loads(meta.content).get("public_url")
 
     async def list_files(self, path: str, limit: int = 50) -> list[dict]:
-        """List only files in a folder. Returns [{'name': str, 'path': str}]."""
-        async with httpx.AsyncClient(timeout=60) as client:
-            r = await client.get(
-                f"{API}/resources",
-                headers=self._headers(),
-                params={"path": path, "limit": str(limit)},
-            )
-            if r.status_code == 404:
-                return []
-            r.raise_for_status()
-            data = r.json()
+        """List only files in a folder. Returns [{'name': str, 'path': str}], cached for LIST_TTL seconds."""
+        hit = self._list_cache.get(path)
+        if hit is not None and hit[1] == limit and time.monotonic() - hit[0] < LIST_TTL:
+            return hit[2]
+        # параллельные запросы одной папки ждут один GET
+        async with self._list_locks.hold(path):
+            hit = self._list_cache.get(path)
+            if hit is not None and hit[1] == limit and time.monotonic() - hit[0] < LIST_TTL:
+                return hit[2]
+            started, gen = time.monotonic(), self._list_gen
+            out = await self._list_files(path, limit)
+            # upload/delete во время запроса — результат мог устареть, не кэшируем
+            if gen == self._list_gen:
+                self._list_cache[path] = (started, limit, out)
+            return out
+
+    async def _list_files(self, path: str, limit: int) -> list[dict]:
+        client = await self._client_ready()
+        r = await client.get(
+            f"{API}/resources",
+            headers=self._headers(),
+            params={"path": path, "limit": str(limit)},
+        )
+        if r.status_code == 404:
+            return []
+        r.raise_for_status()
+        data = json_loads(r.content)
 
         items = (data.get("_embedded") or {}).get("items") or []
         out: list[dict] = []
@@ -90,12 +165,12 @@ class YDisk:
 
     async def get_download_url(self, path: str) -> str:
         """Return temporary direct download URL (href) for a file."""
-        async with httpx.AsyncClient(timeout=60) as client:
-            r = await client.get(
-                f"{API}/resources/download",
-                headers=self._headers(),
-                params={"path": path},
-            )
-            r.raise_for_status()
-            data = r.json()
-        return data.get("href") or ""
\ No newline at end of file
+        client = await self._client_ready()
+        r = await client.get(
+            f"{API}/resources/download",
+            headers=self._headers(),
+            params={"path": path},
+        )
+        r.raise_for_status()
+        data = json_loads(r.content)
+        return data.get("href") or ""